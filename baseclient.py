@@ -1,14 +1,31 @@
 import asyncio
 import inspect
-import json
-import os
-import struct
+import random
 import sys
-import tempfile
+import time
 from typing import Union
 
+import ipc
+from codec import get_codec, is_error, peek_nonce
+from events import EventDispatcher
 from exceptions import *
-from payloads import Payload
+from ipc import _HEADER, OP_CLOSE, OP_FRAME, OP_PING, OP_PONG, IPCProtocol
+from payloads import Activity, ActivityValidator, Payload
+from ready import Ready
+from utils import LoopThread, LRUCache
+
+# Anything that means the pipe is gone and a fresh handshake is needed.
+CONNECTION_ERRORS = (OSError, EOFError, InvalidPipe, InvalidID)
+
+
+def backoff_delays(base: float, maximum: float):
+    """Jittered exponential backoff: yields base, 2*base, ... up to maximum, each scaled by 0.5-1."""
+    attempt = 0
+    while True:
+        delay = min(maximum, base * 2 ** attempt)
+        # Half fixed, half random, so clients that lost Discord together don't retry together.
+        yield delay / 2 + random.uniform(0, delay / 2)
+        attempt = min(attempt + 1, 32)
 
 
 class BaseClient:
@@ -18,32 +35,60 @@ class BaseClient:
         loop = kwargs.get('loop', None)
         handler = kwargs.get('handler', None)
         self.isasync = kwargs.get('isasync', False)
+        self.reconnecting = kwargs.get('reconnect', False)
+        self.backoff_base = kwargs.get('backoff_base', 1.0)
+        self.backoff_max = kwargs.get('backoff_max', 60.0)
+        self.codec = get_codec(kwargs.get('codec', None))
+        # With fast_acks, SET_ACTIVITY replies are only checked for errors, and not decoded
+        # at all unless the codec decodes faster than a scan (peek_acks).
+        self.fast_acks = kwargs.get('fast_acks', False)
+        # Writers wait in send() once this much is queued for Discord, until it drops below write_low.
+        self.write_high = kwargs.get('write_high', 64 * 1024)
+        self.write_low = kwargs.get('write_low', 16 * 1024)
+        # validate='truncate' or 'strict' checks activities against Discord's limits before sending.
+        validate = kwargs.get('validate', None)
+        self.validator = ActivityValidator(validate) if validate else None
+        # Seconds to wait for a reply before raising ResponseTimeout; every command can override it.
+        self.timeout = kwargs.get('timeout', 10.0)
 
         client_id = str(client_id)
-        if sys.platform == 'linux' or sys.platform == 'darwin':
-            tempdir = (os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir())
-            snap_path = '{0}/snap.discord'.format(tempdir)
-            flatpak_path = '{0}/app/com.discordapp.Discord'.format(tempdir)
-            pipe_file = 'discord-ipc-{0}'.format(pipe)
-            if os.path.isdir(snap_path):
-                self.ipc_path = '{0}/{1}'.format(snap_path, pipe_file)
-            elif os.path.isdir(flatpak_path):
-                self.ipc_path = '{0}/{1}'.format(flatpak_path, pipe_file)
-            else:
-                self.ipc_path = '{0}/{1}'.format(tempdir, pipe_file)
-        elif sys.platform == 'win32':
-            self.ipc_path = r'\\?\pipe\discord-ipc-' + str(pipe)
+        # pipe=None finds whichever endpoint Discord is listening on; ipc_cache (anything with
+        # get/update, e.g. state.StateJournal) remembers it so the next start tries it first.
+        self.ipc_path = kwargs.get('ipc_path', None)
+        self.discover = pipe is None and self.ipc_path is None
+        self.ipc_cache = kwargs.get('ipc_cache', None)
+        self.discover_timeout = kwargs.get('discover_timeout', 1.0)
+        # Called with the new Ready whenever a reconnect brings a fresh READY; may be a coroutine function.
+        self.on_ready = kwargs.get('on_ready', None)
+        if self.ipc_path is None and not self.discover:
+            self.ipc_path = ipc.ipc_path(pipe)
 
-        if loop is not None:
-            self.update_event_loop(loop)
+        # The sync classes run their loop on a private daemon thread and hand it work from any
+        # thread; the async ones use the caller's loop. Neither touches the global event loop.
+        self._loop_thread = None  # type: LoopThread
+        if self.isasync:
+            self.update_event_loop(loop or self.get_event_loop())
         else:
-            self.update_event_loop(self.get_event_loop())
+            self._loop_thread = LoopThread(loop or self.get_event_loop(force_fresh=True))
+            self.update_event_loop(self._loop_thread.loop)
 
-        self.sock_reader = None  # type: asyncio.StreamReader
-        self.sock_writer = None  # type: asyncio.StreamWriter
+        self.sock_writer = None  # type: asyncio.Transport
+        self._protocol = None  # type: IPCProtocol
+        self._frames = None  # type: asyncio.Queue
 
         self.client_id = client_id
+        self.ready = None  # type: Ready
+        self.reconnects = 0
+        self.timeouts = 0
+        self.last_io = 0.0
+        self._last_activity = None
+        self._pending = {}
+        self._acks = set()
+        # Nonces of requests that timed out, so their late replies are dropped rather than read as events.
+        self._expired = LRUCache(256)
+        self._reconnect_task = None  # type: asyncio.Task
 
+        self.handler = None
         if handler is not None:
             if not inspect.isfunction(handler):
                 raise PyPresenceException('Error handler must be a function.')
@@ -61,13 +106,16 @@ class BaseClient:
             else:
                 err_handler = self._err_handle
 
-            loop.set_exception_handler(err_handler)
+            self.loop.set_exception_handler(err_handler)
             self.handler = handler
 
         if getattr(self, "on_event", None):  # Tasty bad code ;^)
             self._events_on = True
+            self.events = EventDispatcher(self, kwargs.get('event_queue_size', 256), kwargs.get('event_workers', 4),
+                                          kwargs.get('event_ordered', False), kwargs.get('event_overflow', 'drop_oldest'))
         else:
             self._events_on = False
+            self.events = None
 
     def get_event_loop(self, force_fresh=False):
         if sys.platform == 'linux' or sys.platform == 'darwin':
@@ -87,56 +135,285 @@ class BaseClient:
 
     def update_event_loop(self, loop):
         self.loop = loop
-        asyncio.set_event_loop(self.loop)
+
+    def _submit(self, coro):
+        """Run ``coro`` on the client's loop thread. Safe from any thread; returns a concurrent.futures.Future."""
+        return self._loop_thread.submit(coro)
+
+    def _run(self, coro, wait: bool = True):
+        """Blocking front end of _submit. With ``wait=False`` the Future is returned instead."""
+        if wait and self._loop_thread.in_loop():
+            coro.close()
+            raise PyPresenceException('Blocking calls can\'t be made from the client\'s own event loop '
+                                      '(e.g. inside on_ready); pass wait=False.')
+        future = self._submit(coro)
+        return future.result() if wait else future
 
     def _err_handle(self, loop, context: dict):
-        result = self.handler(context['exception'], context['future'])
-        if inspect.iscoroutinefunction(self.handler):
-            loop.run_until_complete(result)
+        if 'exception' not in context:
+            loop.default_exception_handler(context)
+            return
+        self.report_error(context['exception'], context.get('future'))
+
+    # The loop calls exception handlers synchronously, so the async handler is scheduled, not awaited here.
+    _async_err_handle = _err_handle
+
+    def report_error(self, exc: BaseException, future=None):
+        """Hand ``exc`` to the ``handler`` passed to the client, or to the loop's exception handler."""
+        if self.handler is None:
+            self.loop.call_exception_handler({
+                'message': 'Unhandled exception in event handler',
+                'exception': exc,
+                'future': future,
+            })
+            return
+        result = self.handler(exc, future)
+        if inspect.isawaitable(result):
+            self.loop.create_task(result)
+
+    def _on_frame(self, op: int, body: memoryview):
+        self.last_io = time.monotonic()
+        if self._acks and op == OP_FRAME:
+            nonce = peek_nonce(body)
+            if nonce in self._acks and not is_error(body):
+                waiter = self._pending.pop(nonce, None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(None)
+                return
+        payload = self.codec.loads(body)
+        if op == OP_PING:
+            self.send_data(OP_PONG, payload)
+            return
+        nonce = payload.get('nonce')
+        waiter = self._pending.pop(nonce, None)
+        if waiter is not None:
+            if not waiter.done():
+                waiter.set_result(payload)
+        elif nonce is not None and self._expired.pop(nonce, None):
+            pass
+        elif op == OP_FRAME and self._events_on and payload.get('cmd') == 'DISPATCH' \
+                and payload.get('evt') not in (None, 'READY'):
+            self._on_dispatch(payload)
+        elif op != OP_PONG:
+            self._frames.put_nowait((op, payload))
 
-    async def _async_err_handle(self, loop, context: dict):
-        await self.handler(context['exception'], context['future'])
+    def _on_dispatch(self, payload: dict):
+        self.events.put(payload)
 
-    async def read_output(self):
+    def _fail_pending(self, exc: BaseException):
+        pending, self._pending = self._pending, {}
+        for waiter in pending.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+        if self._frames is not None:
+            self._frames.put_nowait((OP_CLOSE, exc))
+
+    def _on_connection_lost(self, protocol: IPCProtocol, exc):
+        if protocol is self._protocol:
+            self._fail_pending(exc or ConnectionResetError('Discord closed the pipe'))
+
+    async def _read_frame(self):
+        op, payload = await self._frames.get()
+        if op == OP_CLOSE:
+            if isinstance(payload, BaseException):
+                raise payload
+            raise ConnectionResetError('Discord closed the pipe')
+        return op, payload
+
+    async def read_output(self, timeout: float = None):
         try:
-            preamble = await self.sock_reader.read(8)
-            status_code, length = struct.unpack('<II', preamble[:8])
-            data = await self.sock_reader.read(length)
-        except BrokenPipeError:
-            raise InvalidID
-        payload = json.loads(data.decode('utf-8'))
+            op, payload = await asyncio.wait_for(self._read_frame(), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise ResponseTimeout(timeout)
         if payload["evt"] == "ERROR":
             raise ServerError(payload["data"]["message"])
         return payload
 
     def send_data(self, op: int, payload: Union[dict, Payload]):
         if isinstance(payload, Payload):
-            payload = payload.data
-        payload = json.dumps(payload)
+            cmd = payload.cmd
+            data = payload.encode(self.codec)
+        else:
+            cmd = payload.get('cmd')
+            data = self.codec.dumps(payload)
+        if cmd == 'SET_ACTIVITY':
+            self._last_activity = payload
 
         assert self.sock_writer is not None, "You must connect your client before sending events!"
 
-        self.sock_writer.write(
-            struct.pack(
-                '<II',
-                op,
-                len(payload)) +
-            payload.encode('utf-8'))
+        self.sock_writer.writelines((_HEADER.pack(op, len(data)), data))
+
+    async def send(self, op: int, payload: Union[dict, Payload]):
+        """send_data, but first wait for room if Discord is not keeping up with what we write."""
+        if self._protocol is None:
+            raise ConnectionResetError('Pipe closed')
+        await self._protocol.drain()
+        self.send_data(op, payload)
+
+    @property
+    def buffered_bytes(self) -> int:
+        """Bytes written but not yet accepted by the pipe."""
+        if self.sock_writer is None:
+            return 0
+        return self.sock_writer.get_write_buffer_size()
+
+    def _activity_payload(self, activity: Activity, pid: int) -> Payload:
+        if self.validator is not None:
+            activity = self.validator(activity)
+        return Payload.from_activity(activity, pid)
+
+    async def _send_and_wait(self, op: int, payload: Union[dict, Payload], waiter: asyncio.Future):
+        # send_data writes a whole frame synchronously, so cancelling here never leaves half a frame behind.
+        await self.send(op, payload)
+        return await waiter
+
+    async def _request(self, payload: Union[dict, Payload], op: int = OP_FRAME, ack: bool = False,
+                       timeout: float = None):
+        nonce = payload.request_nonce if isinstance(payload, Payload) else payload['nonce']
+        if timeout is None:
+            timeout = self.timeout
+        waiter = self.loop.create_future()
+        self._pending[nonce] = waiter
+        if ack and self.codec.peek_acks:
+            self._acks.add(nonce)
+        try:
+            reply = await asyncio.wait_for(self._send_and_wait(op, payload, waiter), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise ResponseTimeout(timeout)
+        finally:
+            if self._pending.pop(nonce, None) is not None:
+                # Timed out or cancelled before the reply came; drop it if it turns up later.
+                self._expired.put(nonce, True)
+            self._acks.discard(nonce)
+        if reply is not None and reply.get("evt") == "ERROR":
+            raise ServerError(reply["data"]["message"])
+        return None if ack else reply
+
+    async def request(self, payload: Union[dict, Payload], ack: bool = False, timeout: float = None):
+        """Send a command and wait for the reply carrying the same nonce.
+
+        Any number of requests may be in flight at once over the same pipe.
+        With ``ack`` the reply is only checked for an error and None is returned.
+        ``timeout`` overrides the client's default; it bounds the wait for a reply,
+        not the time spent reconnecting.
+        """
+        try:
+            return await self._request(payload, ack=ack, timeout=timeout)
+        except CONNECTION_ERRORS:
+            if not self.reconnecting:
+                raise
+        try:
+            reply = await self._reconnect()
+        except ServerError:
+            # Discord rejected the replayed activity; only ours matters here.
+            if payload is self._last_activity:
+                raise
+        else:
+            if payload is self._last_activity:
+                return reply
+        return await self._request(payload, ack=ack, timeout=timeout)
+
+    def _backoff(self):
+        return backoff_delays(self.backoff_base, self.backoff_max)
+
+    async def _close(self):
+        if self.sock_writer is not None:
+            self.send_data(OP_CLOSE, {'v': 1, 'client_id': self.client_id})
+        self._close_pipe()
+        if self.events is not None:
+            self.events.stop()
+
+    def _stop_loop(self):
+        self._run(self._close())
+        self._loop_thread.stop()
+
+    def _close_pipe(self):
+        if self.sock_writer is not None:
+            self.sock_writer.close()
+        self._fail_pending(ConnectionResetError('Pipe closed'))
+        self.sock_writer = self._protocol = None
+
+    async def _reconnect(self):
+        """Handshake again, backing off between attempts, and replay the last activity.
+
+        Concurrent callers share a single reconnect.
+        """
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = self.loop.create_task(self._reconnect_once())
+            # Callers may time out and leave it running; its outcome is theirs to see, not the loop's.
+            self._reconnect_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return await asyncio.shield(self._reconnect_task)
+
+    async def _reconnect_once(self):
+        for delay in self._backoff():
+            self._close_pipe()
+            try:
+                await self.handshake()
+            except CONNECTION_ERRORS:
+                await asyncio.sleep(delay)
+            else:
+                break
+        self.reconnects += 1
+        if self._last_activity is not None:
+            return await self._request(self._last_activity, ack=self.fast_acks)
+
+    async def _ping(self, timeout: float = 5.0):
+        """Round-trip a PING frame. Returns the latency in seconds."""
+        sent = time.monotonic()
+        try:
+            await self._request({'nonce': Payload.nonce()}, OP_PING, timeout=timeout)
+        except ResponseTimeout:
+            self._close_pipe()
+            raise ConnectionResetError('No PONG from Discord within {0}s'.format(timeout))
+        return time.monotonic() - sent
+
+    async def _keepalive(self, interval: float = 30.0, timeout: float = 5.0):
+        """Ping if the pipe has been quiet for ``interval`` seconds, reconnecting if it is dead."""
+        if time.monotonic() - self.last_io < interval:
+            return
+        try:
+            await self._ping(timeout)
+        except CONNECTION_ERRORS:
+            if not self.reconnecting:
+                raise
+            await self._reconnect()
 
     async def handshake(self):
-        if sys.platform == 'linux' or sys.platform == 'darwin':
-            self.sock_reader, self.sock_writer = await asyncio.open_unix_connection(self.ipc_path, loop=self.loop)
-        elif sys.platform == 'win32' or sys.platform == 'win64':
-            self.sock_reader = asyncio.StreamReader(loop=self.loop)
-            reader_protocol = asyncio.StreamReaderProtocol(
-                self.sock_reader, loop=self.loop)
+        if self.discover:
+            preferred = self.ipc_cache.get('ipc_path') if self.ipc_cache is not None else None
+            path, transport, ready = await ipc.discover(self.loop, self.client_id, self.codec,
+                                                        self.discover_timeout, preferred)
+            if self.ipc_cache is not None:
+                self.ipc_cache.update(ipc_path=path)
+        else:
             try:
-                self.sock_writer, _ = await self.loop.create_pipe_connection(lambda: reader_protocol, self.ipc_path)
-            except FileNotFoundError:
-                raise InvalidPipe
-        self.send_data(0, {'v': 1, 'client_id': self.client_id})
-        preamble = await self.sock_reader.read(8)
-        code, length = struct.unpack('<ii', preamble)
-        data = await self.sock_reader.read(length)
-        if self._events_on:
-            self.sock_reader.feed_data = self.on_event
+                path, transport, ready = await ipc.connect(self.loop, self.ipc_path, self.client_id, self.codec,
+                                                           self.timeout)
+            except asyncio.TimeoutError:
+                # A pipe that never sends READY is as good as no pipe; let the backoff retry it.
+                raise ConnectionResetError('No READY from Discord within {0}s'.format(self.timeout))
+        self.ipc_path = path
+        self._frames = asyncio.Queue()
+        protocol = IPCProtocol(self)
+        transport.set_protocol(protocol)
+        protocol.connection_made(transport)
+        self.sock_writer = transport
+        self._protocol = protocol
+        if self.events is not None:
+            self.events.start(self.loop)
+        self.last_io = time.monotonic()
+        previous, self.ready = self.ready, Ready.from_payload(ready)
+        if previous is not None and self.on_ready is not None:
+            try:
+                result = self.on_ready(self.ready)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                self.report_error(e)
+
+    @property
+    def user(self):
+        """The user Discord reported in READY, without another round trip."""
+        return None if self.ready is None else self.ready.user
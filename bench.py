@@ -0,0 +1,223 @@
+"""Offline benchmarks for the iTunesRPC hot paths.
+
+Run ``python bench.py`` for everything or ``python bench.py <name>`` for one.
+Nothing here needs iTunes or Discord.
+"""
+import json
+import random
+import struct
+import sys
+import timeit
+import tracemalloc
+
+import codec
+from payloads import Activity, Payload
+from player import FakeApplication, FakeTrack, PlayerSource
+from presence import ChangeFilter
+from scheduler import Scheduler
+from utils import remove_none
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def bench_scheduler(hours: int = 24, seed: int = 1):
+    """Simulated latency from a player change to the poll that notices it.
+
+    Besides tracks that play to the end, the playlist has skips part way through
+    a track and pauses that are resumed later, which only a poll can catch.
+    """
+    rng = random.Random(seed)
+    clock = [0.0]
+    app = FakeApplication(clock=lambda: clock[0])
+    end = hours * 3600
+
+    def playlist():
+        # (time, kind, track, paused, position)
+        changes, t, kind = [], 0.0, 'end'
+        while t < end:
+            duration = rng.randint(90, 420)
+            track = FakeTrack('song', 'artist', 'album', duration)
+            changes.append((t, kind, track, False, 0))
+            roll, kind = rng.random(), 'end'
+            if roll < 0.2:
+                t += rng.uniform(5, duration - 5)
+                kind = 'skip'
+            elif roll < 0.35:
+                at = int(rng.uniform(5, duration - 5))
+                changes.append((t + at, 'pause', track, True, at))
+                t += at + rng.uniform(10, 300)
+                changes.append((t, 'resume', track, False, at))
+                t += duration - at
+            else:
+                t += duration
+        return changes
+
+    changes = playlist()
+    source = PlayerSource(app, clock=lambda: clock[0])
+
+    def run(next_delay):
+        i, now, polls, seen = 0, 0.0, 0, None
+        latencies = {kind: [] for kind in ('end', 'skip', 'pause', 'resume')}
+        while now < end:
+            while i + 1 < len(changes) and changes[i + 1][0] <= now:
+                i += 1
+            started, kind, track, paused, position = changes[i]
+            clock[0] = started
+            app.play(track, position)
+            if paused:
+                app.pause()
+            clock[0] = now
+            snap = source.snapshot()
+            polls += 1
+            if seen != i:
+                if seen is not None:
+                    latencies[kind].append(now - started)
+                seen = i
+            now += next_delay(snap, now)
+        return polls, latencies
+
+    scheduler = Scheduler()
+    results = {
+        'fixed 15s': run(lambda snap, now: 15.0),
+        'deadline': run(scheduler.next_delay),
+    }
+    # An hour with iTunes open and nothing playing.
+    idle = Scheduler()
+    stopped, waited = 0, 0.0
+    while waited < 3600:
+        waited += idle.next_delay(None)
+        stopped += 1
+    print('polls/h while stopped: fixed 15s {0}, deadline {1}'.format(3600 // 15, stopped))
+    for name, (polls, latencies) in results.items():
+        print('{0:>10}: {1:6.1f} polls/h'.format(name, polls / hours))
+        for kind, values in latencies.items():
+            print('{0:>18}: p50 {1:5.2f}s  p99 {2:5.2f}s  max {3:5.2f}s  (n={4})'.format(
+                kind, _percentile(values, 50), _percentile(values, 99), max(values), len(values)))
+
+
+def _ack_frame(activity: dict) -> bytes:
+    ack = json.dumps({'cmd': 'SET_ACTIVITY', 'data': activity, 'evt': None, 'nonce': '1234'}).encode()
+    return struct.pack('<II', 1, len(ack)) + ack
+
+
+def _activity():
+    return Payload.set_activity(details='Some Song by Some Artist', state='from Some Album',
+                                large_image='icon', start=1700000000, end=1700000240)
+
+
+def _timeit(func, number: int) -> float:
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def bench_codec(number: int = 20000):
+    """Per-update cost of encoding SET_ACTIVITY and handling its acknowledgement."""
+    data = _activity().data
+    frame = _ack_frame(data['args']['activity'])
+    body = memoryview(frame)[8:]
+
+    def before():
+        payload = json.dumps(data)
+        struct.pack('<II', 1, len(payload)) + payload.encode('utf-8')
+        json.loads(frame[8:].decode('utf-8'))
+
+    results = [('json.dumps + json.loads (old)', _timeit(before, number))]
+    for name in codec.CODECS:
+        impl = codec.get_codec(name)
+
+        def full():
+            payload = impl.dumps(data)
+            struct.pack('<II', 1, len(payload)) + payload
+            impl.loads(body)
+
+        def fast_ack():
+            payload = impl.dumps(data)
+            struct.pack('<II', 1, len(payload)) + payload
+            codec.peek_nonce(body)
+            codec.is_error(body)
+
+        results.append(('{0} full decode'.format(name), _timeit(full, number)))
+        label = '{0} fast ack{1}'.format(name, '' if impl.peek_acks else ' (unused)')
+        results.append((label, _timeit(fast_ack, number)))
+    for label, usec in results:
+        print('{0:>30}: {1:6.2f} us/update'.format(label, usec))
+
+
+def bench_payload(number: int = 20000):
+    """Building and encoding a SET_ACTIVITY frame: nested dict + remove_none vs compiled template."""
+    kwargs = dict(details='Some Song by Some Artist', state='from Some Album',
+                  large_image='icon', start=1700000000, end=1700000240)
+    stdlib = codec.get_codec('json')
+
+    def from_dict():
+        stdlib.dumps(remove_none(Payload.set_activity(_rn=False, **kwargs).data))
+
+    print('{0:>30}: {1:6.2f} us/update'.format('dict + remove_none', _timeit(from_dict, number)))
+    for name in codec.CODECS:
+        impl = codec.get_codec(name)
+
+        def template():
+            Payload.set_activity(**kwargs).encode(impl)
+
+        print('{0:>30}: {1:6.2f} us/update'.format('compiled template ({0})'.format(name), _timeit(template, number)))
+
+
+def _peak_bytes(func, number: int) -> float:
+    """Mean tracemalloc peak per call: everything a call has allocated at once, freed or not."""
+    func()
+    tracemalloc.start()
+    try:
+        total = 0
+        for _ in range(number):
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            func()
+            total += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return total / number
+
+
+def bench_activity(number: int = 2000):
+    """Per update: the change-filter key plus the SET_ACTIVITY payload, from keyword arguments or an Activity.
+
+    Memory is the tracemalloc peak of building both; encoding is timed too but left out of
+    the peak, since every path shares the same template and the codec's own buffers dwarf the rest.
+    """
+    kwargs = dict(details='Some Song by Some Artist', state='from Some Album',
+                  large_image='icon', start=1700000000, end=1700000240)
+    impl = codec.get_codec('json')
+
+    def from_dict():
+        key = ChangeFilter.canonical(**kwargs)
+        return key, remove_none(Payload.set_activity(_rn=False, **kwargs).data)
+
+    def from_kwargs():
+        return ChangeFilter.canonical(**kwargs), Payload.set_activity(**kwargs)
+
+    def from_activity():
+        activity = Activity(**kwargs)
+        return hash(ChangeFilter.canonical(activity=activity)), Payload.from_activity(activity)
+
+    for label, build, encode in (('dict + remove_none', from_dict, lambda: impl.dumps(from_dict()[1])),
+                                 ('keywords + template', from_kwargs, lambda: from_kwargs()[1].encode(impl)),
+                                 ('Activity', from_activity, lambda: from_activity()[1].encode(impl))):
+        print('{0:>30}: {1:5.0f} B peak  {2:6.2f} us/update'.format(
+            label, _peak_bytes(build, number), _timeit(encode, number * 10)))
+
+
+BENCHMARKS = {
+    'scheduler': bench_scheduler,
+    'codec': bench_codec,
+    'payload': bench_payload,
+    'activity': bench_activity,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print('== {0} =='.format(name))
+        BENCHMARKS[name]()
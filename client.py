@@ -1,18 +1,236 @@
+import asyncio
 import inspect
-import json
 import os
+import threading
+import time
+from concurrent.futures import Future
 from typing import List
 
 from baseclient import BaseClient
 from exceptions import *
-from payloads import Payload
+from payloads import Activity, Payload
+from utils import LRUCache
+from voice import user_voice_settings_writer, voice_settings_writer
+
+# Which cached commands an event makes stale. Events only arrive for what has been subscribed to;
+# everything else just ages out.
+_INVALIDATES = {
+    'GUILD_CREATE': ('GET_GUILDS', 'GET_GUILD'),
+    'GUILD_STATUS': ('GET_GUILD',),
+    'CHANNEL_CREATE': ('GET_CHANNELS',),
+    'VOICE_SETTINGS_UPDATE': ('GET_VOICE_SETTINGS',),
+}
+
+
+class ResponseCache:
+    """TTL + LRU cache of replies to read-only commands, keyed by ``(cmd, argument)``.
+
+    Replies are shared between callers, so don't modify them.
+    """
+
+    def __init__(self, ttl: float = 60.0, maxsize: int = 128, clock=time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = LRUCache(maxsize)
+        self._generations = {}
+        # The sync Client reads from caller threads and writes from its loop thread.
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    @property
+    def evictions(self) -> int:
+        return self._entries.evictions
+
+    @property
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'expired': self.expired}
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self._clock():
+                self._entries.pop(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, cmd: str) -> int:
+        return self._generations.get(cmd, 0)
+
+    def put(self, key: tuple, reply: dict, generation: int):
+        """Store ``reply`` unless ``key``'s command was invalidated since ``generation`` was read."""
+        with self._lock:
+            if self._generations.get(key[0], 0) == generation:
+                self._entries.put(key, (self._clock() + self.ttl, reply))
+
+    def invalidate(self, *cmds: str):
+        with self._lock:
+            for cmd in cmds:
+                self._generations[cmd] = self._generations.get(cmd, 0) + 1
+            for key in [key for key in self._entries.keys() if key[0] in cmds]:
+                self._entries.pop(key)
+
+    def clear(self):
+        with self._lock:
+            for cmd in {key[0] for key in self._entries.keys()}:
+                self._generations[cmd] = self._generations.get(cmd, 0) + 1
+            self._entries.clear()
+
+    def on_event(self, evt: str):
+        cmds = _INVALIDATES.get(evt)
+        if cmds is not None:
+            self.invalidate(*cmds)
+
+
+def _response_cache(kwargs: dict):
+    """cache_ttl= turns the cache on; cache_size= bounds it."""
+    ttl = kwargs.pop('cache_ttl', None)
+    size = kwargs.pop('cache_size', 128)
+    return None if ttl is None else ResponseCache(ttl, size)
+
+
+async def _write(client, payload: Payload, timeout: float, stale: str):
+    """Send a command that changes what ``stale`` returns, then drop its cached reply."""
+    try:
+        return await client.request(payload, timeout=timeout)
+    finally:
+        if client.cache is not None:
+            client.cache.invalidate(stale)
+
+
+def _voice_args(**fields) -> dict:
+    return {key: value for key, value in fields.items() if value is not None}
+
+
+def _user_voice_args(pan_left, pan_right, volume, mute) -> dict:
+    args = _voice_args(pan=_voice_args(left=pan_left, right=pan_right), volume=volume, mute=mute)
+    if not args.get('pan'):
+        args.pop('pan', None)
+    return args
+
+
+async def _merge_voice(client, writer, args: dict, timeout: float):
+    """Merge ``args`` into the writer's next batch without waiting for the write; its errors go to report_error."""
+    waiter = await writer.merge(args, timeout)
+    waiter.add_done_callback(lambda f: f.cancelled() or f.exception() is None or client.report_error(f.exception(), f))
+
+
+async def _fetch(client, key: tuple, make_payload, timeout: float):
+    generation = client.cache.generation(key[0])
+    reply = await client.request(make_payload(), timeout=timeout)
+    client.cache.put(key, reply, generation)
+    return reply
+
+
+async def _lookup(client, key: tuple, make_payload, timeout: float):
+    if client.cache is None:
+        return await client.request(make_payload(), timeout=timeout)
+    reply = client.cache.get(key)
+    if reply is None:
+        reply = await _fetch(client, key, make_payload, timeout)
+    return reply
+
+
+async def _bulk(client, cmd: str, make_payload, ids, limit: int, timeout: float):
+    """Yields ``(id, reply)`` as replies arrive, keeping at most ``limit`` requests in flight.
+
+    Every request shares the one pipe, so throughput grows with ``limit`` rather than
+    being one round trip per id. The first error cancels the rest and is raised.
+    """
+    ids = iter(dict.fromkeys(str(i) for i in ids))
+    results = asyncio.Queue()
+
+    async def worker():
+        # Workers share one iterator, so each id is fetched exactly once.
+        try:
+            for i in ids:
+                results.put_nowait((i, await _lookup(client, (cmd, i), lambda: make_payload(i), timeout)))
+        except Exception as e:
+            results.put_nowait(e)
+        else:
+            results.put_nowait(None)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max(1, limit or client.max_in_flight))]
+    try:
+        running = len(workers)
+        while running:
+            item = await results.get()
+            if item is None:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+async def _collect(results) -> dict:
+    return {i: reply async for i, reply in results}
+
+
+async def _guild_ids(client, timeout: float) -> list:
+    reply = await _lookup(client, ('GET_GUILDS',), Payload.get_guilds, timeout)
+    return [guild['id'] for guild in reply['data']['guilds']]
+
+
+async def _guilds_detailed(client, limit: int, timeout: float):
+    ids = await _guild_ids(client, timeout)
+    async for item in _bulk(client, 'GET_GUILD', Payload.get_guild, ids, limit, timeout):
+        yield item
 
 
 class Client(BaseClient):
     def __init__(self, *args, **kwargs):
+        self.cache = _response_cache(kwargs)
         super().__init__(*args, **kwargs)
         self._closed = False
         self._events = {}
+        # voice_interval= makes voice settings writes delta-only, merged over that many seconds.
+        # With wait=True a call returns once it is merged; wait=False gives a future for the write's reply.
+        self.voice_interval = kwargs.get('voice_interval', None)
+        self.voice = None if self.voice_interval is None else voice_settings_writer(self, self.voice_interval)
+        self._user_voice = {}
+        # Upper bound on requests a bulk query keeps outstanding at once.
+        self.max_in_flight = kwargs.get('max_in_flight', 8)
+
+    def _on_dispatch(self, payload: dict):
+        if self.cache is not None:
+            self.cache.on_event(payload['evt'])
+        if self.voice is not None and payload['evt'] == 'VOICE_SETTINGS_UPDATE':
+            self.voice.seed(payload['data'])
+        super()._on_dispatch(payload)
+
+    def _user_voice_writer(self, user_id: str):
+        writer = self._user_voice.get(str(user_id))
+        if writer is None:
+            writer = self._user_voice[str(user_id)] = user_voice_settings_writer(self, self.voice_interval, user_id)
+        return writer
+
+    async def handshake(self):
+        await super().handshake()
+        # Anything could have changed while we were disconnected.
+        if self.cache is not None:
+            self.cache.clear()
+
+    def _query(self, key: tuple, make_payload, timeout: float, wait: bool):
+        if self.cache is None:
+            return self._run(self.request(make_payload(), timeout=timeout), wait)
+        reply = self.cache.get(key)
+        if reply is None:
+            return self._run(_fetch(self, key, make_payload, timeout), wait)
+        if wait:
+            return reply
+        future = Future()
+        future.set_result(reply)
+        return future
 
     def register_event(self, event: str, func: callable, args: dict = {}):
         if inspect.iscoroutinefunction(func):
@@ -29,83 +247,65 @@ class Client(BaseClient):
         self.unsubscribe(event, args)
         del self._events[event]
 
-    def on_event(self, data):
-        if self.sock_reader._eof:
-            raise PyPresenceException('feed_data after feed_eof')
-        if not data:
-            return
-        self.sock_reader._buffer.extend(data)
-        self.sock_reader._wakeup_waiter()
-        if (self.sock_reader._transport is not None and
-                not self.sock_reader._paused and
-                len(self.sock_reader._buffer) > 2 * self.sock_reader._limit):
-            try:
-                self.sock_reader._transport.pause_reading()
-            except NotImplementedError:
-                self.sock_reader._transport = None
-            else:
-                self.sock_reader._paused = True
-
-        payload = json.loads(data[8:].decode('utf-8'))
+    def on_event(self, payload: dict):
+        evt = payload["evt"].lower()
+        if evt in self._events:
+            self._events[evt](payload["data"])
+        elif evt == 'error':
+            raise DiscordError(payload["data"]["code"], payload["data"]["message"])
 
-        if payload["evt"] is not None:
-            evt = payload["evt"].lower()
-            if evt in self._events:
-                self._events[evt](payload["data"])
-            elif evt == 'error':
-                raise DiscordError(payload["data"]["code"], payload["data"]["message"])
-
-    def authorize(self, client_id: str, scopes: List[str]):
+    def authorize(self, client_id: str, scopes: List[str], timeout: float = None, wait: bool = True):
         payload = Payload.authorize(client_id, scopes)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, timeout=timeout), wait)
 
-    def authenticate(self, token: str):
+    def authenticate(self, token: str, timeout: float = None, wait: bool = True):
         payload = Payload.authenticate(token)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, timeout=timeout), wait)
+
+    def get_guilds(self, timeout: float = None, wait: bool = True):
+        return self._query(('GET_GUILDS',), Payload.get_guilds, timeout, wait)
 
-    def get_guilds(self):
-        payload = Payload.get_guilds()
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+    def get_guild(self, guild_id: str, timeout: float = None, wait: bool = True):
+        return self._query(('GET_GUILD', str(guild_id)), lambda: Payload.get_guild(guild_id), timeout, wait)
 
-    def get_guild(self, guild_id: str):
-        payload = Payload.get_guild(guild_id)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+    def get_channel(self, channel_id: str, timeout: float = None, wait: bool = True):
+        return self._query(('GET_CHANNEL', str(channel_id)), lambda: Payload.get_channel(channel_id), timeout, wait)
 
-    def get_channel(self, channel_id: str):
-        payload = Payload.get_channel(channel_id)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+    def get_channels(self, guild_id: str, timeout: float = None, wait: bool = True):
+        return self._query(('GET_CHANNELS', str(guild_id)), lambda: Payload.get_channels(guild_id), timeout, wait)
 
-    def get_channels(self, guild_id: str):
-        payload = Payload.get_channels(guild_id)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+    def get_channels_bulk(self, channel_ids, limit: int = None, timeout: float = None, wait: bool = True) -> dict:
+        """GET_CHANNEL for every id, ``limit`` (default ``max_in_flight``) at a time. Returns {id: reply}."""
+        results = _bulk(self, 'GET_CHANNEL', Payload.get_channel, channel_ids, limit, timeout)
+        return self._run(_collect(results), wait)
+
+    def get_guilds_detailed(self, limit: int = None, timeout: float = None, wait: bool = True) -> dict:
+        """GET_GUILD for every guild GET_GUILDS lists, ``limit`` at a time. Returns {id: reply}."""
+        return self._run(_collect(_guilds_detailed(self, limit, timeout)), wait)
 
     def set_user_voice_settings(self, user_id: str, pan_left: float = None,
                                 pan_right: float = None, volume: int = None,
-                                mute: bool = None):
+                                mute: bool = None, timeout: float = None, wait: bool = True):
+        if self.voice_interval is not None:
+            args = _user_voice_args(pan_left, pan_right, volume, mute)
+            writer = self._user_voice_writer(user_id)
+            if wait:
+                return self._run(_merge_voice(self, writer, args, timeout))
+            return self._run(writer.set(args, timeout), wait)
         payload = Payload.set_user_voice_settings(user_id, pan_left, pan_right, volume, mute)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, timeout=timeout), wait)
 
-    def select_voice_channel(self, channel_id: str):
+    def select_voice_channel(self, channel_id: str, timeout: float = None, wait: bool = True):
         payload = Payload.select_voice_channel(channel_id)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, timeout=timeout), wait)
 
-    def get_selected_voice_channel(self):
+    def get_selected_voice_channel(self, timeout: float = None, wait: bool = True):
         payload = Payload.get_selected_voice_channel()
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, timeout=timeout), wait)
 
-    def select_text_channel(self, channel_id: str):
+    def select_text_channel(self, channel_id: str, timeout: float = None, wait: bool = True):
         payload = Payload.select_text_channel(channel_id)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, timeout=timeout), wait)
 
     def set_activity(self, pid: int = os.getpid(),
                      state: str = None, details: str = None,
@@ -115,77 +315,116 @@ class Client(BaseClient):
                      party_id: str = None, party_size: list = None,
                      join: str = None, spectate: str = None,
                      match: str = None, buttons: list = None,
-                     instance: bool = True):
-        payload = Payload.set_activity(pid=pid, state=state, details=details, start=start, end=end, large_image=large_image, large_text=large_text,
-                                       small_image=small_image, small_text=small_text, party_id=party_id, party_size=party_size, join=join, spectate=spectate,
-                                       match=match, buttons=buttons, instance=instance, activity=True)
-        
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
-
-    def clear_activity(self, pid: int = os.getpid()):
+                     instance: bool = True, activity: Activity = None,
+                     timeout: float = None, wait: bool = True):
+        if activity is None and self.validator is not None:
+            activity = Activity(state, details, start, end, large_image, large_text, small_image, small_text,
+                                party_id, party_size, join, spectate, match, buttons, instance)
+        if activity is not None:
+            payload = self._activity_payload(activity, pid)
+        else:
+            payload = Payload.set_activity(pid=pid, state=state, details=details, start=start, end=end, large_image=large_image, large_text=large_text,
+                                           small_image=small_image, small_text=small_text, party_id=party_id, party_size=party_size, join=join, spectate=spectate,
+                                           match=match, buttons=buttons, instance=instance, activity=True)
+
+        return self._run(self.request(payload, ack=self.fast_acks, timeout=timeout), wait)
+
+    def clear_activity(self, pid: int = os.getpid(), timeout: float = None, wait: bool = True):
         payload = Payload.set_activity(pid, activity=None)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, ack=self.fast_acks, timeout=timeout), wait)
 
-    def subscribe(self, event: str, args: dict = {}):
+    def subscribe(self, event: str, args: dict = {}, timeout: float = None, wait: bool = True):
         payload = Payload.subscribe(event, args)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, timeout=timeout), wait)
 
-    def unsubscribe(self, event: str, args: dict = {}):
+    def unsubscribe(self, event: str, args: dict = {}, timeout: float = None, wait: bool = True):
         payload = Payload.unsubscribe(event, args)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, timeout=timeout), wait)
 
-    def get_voice_settings(self):
-        payload = Payload.get_voice_settings()
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+    def get_voice_settings(self, timeout: float = None, wait: bool = True):
+        return self._query(('GET_VOICE_SETTINGS',), Payload.get_voice_settings, timeout, wait)
 
     def set_voice_settings(self, _input: dict = None, output: dict = None,
                            mode: dict = None, automatic_gain_control: bool = None,
                            echo_cancellation: bool = None, noise_suppression: bool = None,
                            qos: bool = None, silence_warning: bool = None,
-                           deaf: bool = None, mute: bool = None):
+                           deaf: bool = None, mute: bool = None, timeout: float = None, wait: bool = True):
+        if self.voice is not None:
+            args = _voice_args(input=_input, output=output, mode=mode, automatic_gain_control=automatic_gain_control,
+                               echo_cancellation=echo_cancellation, noise_suppression=noise_suppression, qos=qos,
+                               silence_warning=silence_warning, deaf=deaf, mute=mute)
+            if wait:
+                return self._run(_merge_voice(self, self.voice, args, timeout))
+            return self._run(self.voice.set(args, timeout), wait)
         payload = Payload.set_voice_settings(_input, output, mode, automatic_gain_control, echo_cancellation,
                                              noise_suppression, qos, silence_warning, deaf, mute)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(_write(self, payload, timeout, 'GET_VOICE_SETTINGS'), wait)
 
-    def capture_shortcut(self, action: str):
+    def capture_shortcut(self, action: str, timeout: float = None, wait: bool = True):
         payload = Payload.capture_shortcut(action)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, timeout=timeout), wait)
 
-    def send_activity_join_invite(self, user_id: str):
+    def send_activity_join_invite(self, user_id: str, timeout: float = None, wait: bool = True):
         payload = Payload.send_activity_join_invite(user_id)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, timeout=timeout), wait)
 
-    def close_activity_request(self, user_id: str):
+    def close_activity_request(self, user_id: str, timeout: float = None, wait: bool = True):
         payload = Payload.close_activity_request(user_id)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, timeout=timeout), wait)
 
     def close(self):
-        self.send_data(2, {'v': 1, 'client_id': self.client_id})
-        self.sock_writer.close()
+        self._stop_loop()
         self._closed = True
-        self.loop.close()
 
-    def start(self):
-        self.loop.run_until_complete(self.handshake())
+    def start(self, wait: bool = True):
+        return self._run(self.handshake(), wait)
+
+    def reconnect(self, wait: bool = True):
+        return self._run(self._reconnect(), wait)
+
+    def ping(self, timeout: float = 5.0, wait: bool = True):
+        return self._run(self._ping(timeout), wait)
+
+    def keepalive(self, interval: float = 30.0, timeout: float = 5.0, wait: bool = True):
+        return self._run(self._keepalive(interval, timeout), wait)
 
-    def read(self):
-        return self.loop.run_until_complete(self.read_output())
+    def read(self, timeout: float = None, wait: bool = True):
+        return self._run(self.read_output(timeout), wait)
 
 
 class AioClient(BaseClient):
     def __init__(self, *args, **kwargs):
+        self.cache = _response_cache(kwargs)
         super().__init__(*args, **kwargs, isasync=True)
         self._closed = False
         self._events = {}
+        # voice_interval= makes voice settings writes delta-only, merged over that many seconds.
+        self.voice_interval = kwargs.get('voice_interval', None)
+        self.voice = None if self.voice_interval is None else voice_settings_writer(self, self.voice_interval)
+        self._user_voice = {}
+        # Upper bound on requests a bulk query keeps outstanding at once.
+        self.max_in_flight = kwargs.get('max_in_flight', 8)
+
+    def _on_dispatch(self, payload: dict):
+        if self.cache is not None:
+            self.cache.on_event(payload['evt'])
+        if self.voice is not None and payload['evt'] == 'VOICE_SETTINGS_UPDATE':
+            self.voice.seed(payload['data'])
+        super()._on_dispatch(payload)
+
+    def _user_voice_writer(self, user_id: str):
+        writer = self._user_voice.get(str(user_id))
+        if writer is None:
+            writer = self._user_voice[str(user_id)] = user_voice_settings_writer(self, self.voice_interval, user_id)
+        return writer
+
+    async def handshake(self):
+        await super().handshake()
+        if self.cache is not None:
+            self.cache.clear()
+
+    async def _query(self, key: tuple, make_payload, timeout: float):
+        return await _lookup(self, key, make_payload, timeout)
 
     async def register_event(self, event: str, func: callable, args: dict = {}):
         if not inspect.iscoroutinefunction(func):
@@ -202,83 +441,68 @@ class AioClient(BaseClient):
         await self.unsubscribe(event, args)
         del self._events[event]
 
-    async def on_event(self, data):
-        if self.sock_reader._eof:
-            raise PyPresenceException('feed_data after feed_eof')
-        if not data:
-            return
-        self.sock_reader._buffer.extend(data)
-        self.sock_reader._wakeup_waiter()
-        if (self.sock_reader._transport is not None and
-                not self.sock_reader._paused and
-                len(self.sock_reader._buffer) > 2 * self.sock_reader._limit):
-            try:
-                self.sock_reader._transport.pause_reading()
-            except NotImplementedError:
-                self.sock_reader._transport = None
-            else:
-                self.sock_reader._paused = True
-
-        payload = json.loads(data[8:].decode('utf-8'))
-
-        if payload["evt"] is not None:
-            evt = payload["evt"].lower()
-            if evt in self._events:
-                await self._events[evt](payload["data"])
-            elif evt == 'error':
-                raise DiscordError(payload["data"]["code"], payload["data"]["message"])
+    async def on_event(self, payload: dict):
+        evt = payload["evt"].lower()
+        if evt in self._events:
+            await self._events[evt](payload["data"])
+        elif evt == 'error':
+            raise DiscordError(payload["data"]["code"], payload["data"]["message"])
 
-    async def authorize(self, client_id: str, scopes: List[str]):
+    async def authorize(self, client_id: str, scopes: List[str], timeout: float = None):
         payload = Payload.authorize(client_id, scopes)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, timeout=timeout)
 
-    async def authenticate(self, token: str):
+    async def authenticate(self, token: str, timeout: float = None):
         payload = Payload.authenticate(token)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, timeout=timeout)
 
-    async def get_guilds(self):
-        payload = Payload.get_guilds()
-        self.send_data(1, payload)
-        return await self.read_output()
+    async def get_guilds(self, timeout: float = None):
+        return await self._query(('GET_GUILDS',), Payload.get_guilds, timeout)
 
-    async def get_guild(self, guild_id: str):
-        payload = Payload.get_guild(guild_id)
-        self.send_data(1, payload)
-        return await self.read_output()
+    async def get_guild(self, guild_id: str, timeout: float = None):
+        return await self._query(('GET_GUILD', str(guild_id)), lambda: Payload.get_guild(guild_id), timeout)
 
-    async def get_channel(self, channel_id: str):
-        payload = Payload.get_channel(channel_id)
-        self.send_data(1, payload)
-        return await self.read_output()
+    async def get_channel(self, channel_id: str, timeout: float = None):
+        return await self._query(('GET_CHANNEL', str(channel_id)), lambda: Payload.get_channel(channel_id), timeout)
 
-    async def get_channels(self, guild_id: str):
-        payload = Payload.get_channels(guild_id)
-        self.send_data(1, payload)
-        return await self.read_output()
+    async def get_channels(self, guild_id: str, timeout: float = None):
+        return await self._query(('GET_CHANNELS', str(guild_id)), lambda: Payload.get_channels(guild_id), timeout)
+
+    async def get_channels_bulk(self, channel_ids, limit: int = None, timeout: float = None) -> dict:
+        """GET_CHANNEL for every id, ``limit`` (default ``max_in_flight``) at a time. Returns {id: reply}."""
+        return await _collect(self.iter_channels(channel_ids, limit, timeout))
+
+    def iter_channels(self, channel_ids, limit: int = None, timeout: float = None):
+        """Like get_channels_bulk, but an async iterator of (id, reply) in the order replies arrive."""
+        return _bulk(self, 'GET_CHANNEL', Payload.get_channel, channel_ids, limit, timeout)
+
+    async def get_guilds_detailed(self, limit: int = None, timeout: float = None) -> dict:
+        """GET_GUILD for every guild GET_GUILDS lists, ``limit`` at a time. Returns {id: reply}."""
+        return await _collect(self.iter_guilds_detailed(limit, timeout))
+
+    def iter_guilds_detailed(self, limit: int = None, timeout: float = None):
+        return _guilds_detailed(self, limit, timeout)
 
     async def set_user_voice_settings(self, user_id: str, pan_left: float = None,
                                       pan_right: float = None, volume: int = None,
-                                      mute: bool = None):
+                                      mute: bool = None, timeout: float = None):
+        if self.voice_interval is not None:
+            args = _user_voice_args(pan_left, pan_right, volume, mute)
+            return await self._user_voice_writer(user_id).set(args, timeout)
         payload = Payload.set_user_voice_settings(user_id, pan_left, pan_right, volume, mute)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, timeout=timeout)
 
-    async def select_voice_channel(self, channel_id: str):
+    async def select_voice_channel(self, channel_id: str, timeout: float = None):
         payload = Payload.select_voice_channel(channel_id)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, timeout=timeout)
 
-    async def get_selected_voice_channel(self):
+    async def get_selected_voice_channel(self, timeout: float = None):
         payload = Payload.get_selected_voice_channel()
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, timeout=timeout)
 
-    async def select_text_channel(self, channel_id: str):
+    async def select_text_channel(self, channel_id: str, timeout: float = None):
         payload = Payload.select_text_channel(channel_id)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, timeout=timeout)
 
     async def set_activity(self, pid: int = os.getpid(),
                            state: str = None, details: str = None,
@@ -287,57 +511,60 @@ class AioClient(BaseClient):
                            small_image: str = None, small_text: str = None,
                            party_id: str = None, party_size: list = None,
                            join: str = None, spectate: str = None,
-                           match: str = None, instance: bool = True):
-        payload = Payload.set_activity(pid, state, details, start, end, large_image, large_text,
-                                       small_image, small_text, party_id, party_size, join, spectate,
-                                       match, instance, activity=True)
-        self.send_data(1, payload)
-        return await self.read_output()
-
-    async def clear_activity(self, pid: int = os.getpid()):
+                           match: str = None, buttons: list = None,
+                           instance: bool = True, activity: Activity = None,
+                           timeout: float = None):
+        if activity is None and self.validator is not None:
+            activity = Activity(state, details, start, end, large_image, large_text, small_image, small_text,
+                                party_id, party_size, join, spectate, match, buttons, instance)
+        if activity is not None:
+            payload = self._activity_payload(activity, pid)
+        else:
+            payload = Payload.set_activity(pid=pid, state=state, details=details, start=start, end=end, large_image=large_image, large_text=large_text,
+                                           small_image=small_image, small_text=small_text, party_id=party_id, party_size=party_size, join=join, spectate=spectate,
+                                           match=match, buttons=buttons, instance=instance, activity=True)
+        return await self.request(payload, ack=self.fast_acks, timeout=timeout)
+
+    async def clear_activity(self, pid: int = os.getpid(), timeout: float = None):
         payload = Payload.set_activity(pid, activity=None)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, ack=self.fast_acks, timeout=timeout)
 
-    async def subscribe(self, event: str, args: dict = {}):
+    async def subscribe(self, event: str, args: dict = {}, timeout: float = None):
         payload = Payload.subscribe(event, args)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, timeout=timeout)
 
-    async def unsubscribe(self, event: str, args: dict = {}):
+    async def unsubscribe(self, event: str, args: dict = {}, timeout: float = None):
         payload = Payload.unsubscribe(event, args)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, timeout=timeout)
 
-    async def get_voice_settings(self):
-        payload = Payload.get_voice_settings()
-        self.send_data(1, payload)
-        return await self.read_output()
+    async def get_voice_settings(self, timeout: float = None):
+        return await self._query(('GET_VOICE_SETTINGS',), Payload.get_voice_settings, timeout)
 
     async def set_voice_settings(self, _input: dict = None, output: dict = None,
                                  mode: dict = None, automatic_gain_control: bool = None,
                                  echo_cancellation: bool = None, noise_suppression: bool = None,
                                  qos: bool = None, silence_warning: bool = None,
-                                 deaf: bool = None, mute: bool = None):
+                                 deaf: bool = None, mute: bool = None, timeout: float = None):
+        if self.voice is not None:
+            args = _voice_args(input=_input, output=output, mode=mode, automatic_gain_control=automatic_gain_control,
+                               echo_cancellation=echo_cancellation, noise_suppression=noise_suppression, qos=qos,
+                               silence_warning=silence_warning, deaf=deaf, mute=mute)
+            return await self.voice.set(args, timeout)
         payload = Payload.set_voice_settings(_input, output, mode, automatic_gain_control, echo_cancellation,
                                              noise_suppression, qos, silence_warning, deaf, mute)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await _write(self, payload, timeout, 'GET_VOICE_SETTINGS')
 
-    async def capture_shortcut(self, action: str):
+    async def capture_shortcut(self, action: str, timeout: float = None):
         payload = Payload.capture_shortcut(action)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, timeout=timeout)
 
-    async def send_activity_join_invite(self, user_id: str):
+    async def send_activity_join_invite(self, user_id: str, timeout: float = None):
         payload = Payload.send_activity_join_invite(user_id)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, timeout=timeout)
 
-    async def close_activity_request(self, user_id: str):
+    async def close_activity_request(self, user_id: str, timeout: float = None):
         payload = Payload.close_activity_request(user_id)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, timeout=timeout)
 
     def close(self):
         self.send_data(2, {'v': 1, 'client_id': self.client_id})
@@ -348,5 +575,14 @@ class AioClient(BaseClient):
     async def start(self):
         await self.handshake()
 
-    async def read(self):
-        return await self.read_output()
+    async def reconnect(self):
+        return await self._reconnect()
+
+    async def ping(self, timeout: float = 5.0):
+        return await self._ping(timeout)
+
+    async def keepalive(self, interval: float = 30.0, timeout: float = 5.0):
+        return await self._keepalive(interval, timeout)
+
+    async def read(self, timeout: float = None):
+        return await self.read_output(timeout)
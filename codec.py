@@ -0,0 +1,116 @@
+"""JSON codecs for IPC frames. Everything works on bytes end to end.
+
+orjson or ujson are used when installed, the standard library otherwise.
+"""
+import json
+import re
+from json.encoder import encode_basestring_ascii
+
+from exceptions import InvalidArgument
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JSONCodec:
+    name = 'json'
+    # Whether scanning an acknowledgement for its nonce beats decoding it.
+    peek_acks = True
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    @staticmethod
+    def dumps_value(value) -> bytes:
+        """Same bytes as ``dumps`` for a single value, skipping the encoder setup for scalars."""
+        kind = type(value)
+        if kind is str:
+            return encode_basestring_ascii(value).encode('ascii')
+        if kind is int:
+            return int.__repr__(value).encode('ascii')
+        if kind is bool:
+            return b'true' if value else b'false'
+        return json.dumps(value).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(str(data, 'utf-8'))
+
+
+class OrjsonCodec:
+    name = 'orjson'
+    # orjson decodes a whole ack faster than the regexes below can scan it.
+    peek_acks = False
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    dumps_value = dumps
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+
+class UjsonCodec:
+    name = 'ujson'
+    peek_acks = True
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    dumps_value = dumps
+
+    @staticmethod
+    def loads(data):
+        return ujson.loads(bytes(data))
+
+
+CODECS = {'json': JSONCodec}
+if ujson is not None:
+    CODECS['ujson'] = UjsonCodec
+if orjson is not None:
+    CODECS['orjson'] = OrjsonCodec
+
+
+def get_codec(name: str = None):
+    """Return the codec called ``name``, or the fastest one installed."""
+    if name is None:
+        for name in ('orjson', 'ujson', 'json'):
+            if name in CODECS:
+                break
+    if name not in CODECS:
+        raise InvalidArgument(' or '.join(CODECS), name, 'That JSON library is not installed.')
+    return CODECS[name]
+
+
+_NONCE = re.compile(rb'"nonce"(?:\s*:\s*"([^"\\]*)")?')
+_EVT = re.compile(rb'"evt"(?:\s*:\s*"([^"\\]*)")?')
+
+
+# A key can also turn up nested inside ``data``, where a search could match it before
+# the top-level one. Bodies holding the key more than once are left to a full decode.
+# Both scan the frame buffer in place; ``re`` takes a memoryview without a copy.
+
+def peek_nonce(body):
+    """Find a frame's nonce without decoding it. Returns None if there isn't exactly one."""
+    found = _NONCE.findall(body)
+    if len(found) != 1 or not found[0]:
+        return None
+    return found[0].decode('ascii', 'replace')
+
+
+def is_error(body) -> bool:
+    """True for an ERROR frame, and for any frame whose ``evt`` can't be told without decoding it."""
+    found = _EVT.findall(body)
+    return len(found) != 1 or found[0] == b'ERROR'
@@ -0,0 +1,178 @@
+"""Asyncio daemon mode: the player poller, presence sender and connection
+supervisor run as separate tasks on one event loop."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from baseclient import CONNECTION_ERRORS
+from exceptions import ResponseTimeout, ServerError
+from nowplaying import NowPlaying
+from player import PlayerSource
+from presence import AioPresence, ChangeFilter, Coalescer, MultiPresence
+from scheduler import Scheduler
+
+
+class Mailbox:
+    """Holds only the newest value. ``put`` never blocks; older unread values are dropped."""
+
+    def __init__(self):
+        self._value = None
+        self._event = asyncio.Event()
+        self.overwritten = 0
+
+    def put(self, value):
+        if self._event.is_set():
+            self.overwritten += 1
+        self._value = value
+        self._event.set()
+
+    def empty(self):
+        return not self._event.is_set()
+
+    async def get(self):
+        await self._event.wait()
+        self._event.clear()
+        value, self._value = self._value, None
+        return value
+
+
+class Daemon:
+    def __init__(self, client_id: str, player_factory: Callable[[], PlayerSource],
+                 nowplaying: NowPlaying, pipe: int = 0, scheduler: Scheduler = None,
+                 ping_interval: float = 30.0, broadcast: bool = False, **presence_kwargs):
+        self.client_id = client_id
+        self.pipe = pipe
+        self.player_factory = player_factory
+        self.nowplaying = nowplaying
+        self.scheduler = scheduler or Scheduler()
+        self.ping_interval = ping_interval
+        self.broadcast = broadcast
+        self.presence_kwargs = presence_kwargs
+        self.presence_kwargs.setdefault('fast_acks', True)
+        # Long song titles are cut to fit instead of being rejected by Discord.
+        self.presence_kwargs.setdefault('validate', 'truncate')
+        self.presence = None  # type: AioPresence
+        self.filter = ChangeFilter()
+        self.mailbox = Mailbox()
+        self.coalescer = Coalescer()
+        # COM objects are bound to the thread that created them, so every player call
+        # goes through the same worker thread.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='player')
+        self._player = None
+        self._connected = None  # type: asyncio.Event
+        self._lost = None  # type: asyncio.Event
+        self._wake = None  # type: asyncio.Event
+        self._stopping = None  # type: asyncio.Event
+
+    def _init_player(self):
+        try:
+            import pythoncom
+        except ImportError:
+            pass
+        else:
+            pythoncom.CoInitialize()
+        self._player = self.player_factory()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    async def run(self):
+        self._connected = asyncio.Event()
+        self._lost = asyncio.Event()
+        self._wake = asyncio.Event()
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._init_player)
+
+        tasks = [asyncio.ensure_future(coro) for coro in (self._poller(), self._sender(), self._supervisor())]
+        stopping = asyncio.ensure_future(self._stopping.wait())
+        try:
+            done, _ = await asyncio.wait(tasks + [stopping], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not stopping:
+                    task.result()
+        finally:
+            for task in tasks + [stopping]:
+                task.cancel()
+            await asyncio.gather(*tasks, stopping, return_exceptions=True)
+            if self.presence is not None:
+                self.presence._close_pipe()
+            self._executor.shutdown(wait=False)
+
+    async def _poller(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping.is_set():
+            track = await loop.run_in_executor(self._executor, self._player.snapshot)
+            self.mailbox.put(self.nowplaying.render(track))
+            delay = self.scheduler.next_delay(track)
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _sender(self):
+        while True:
+            activity = await self.mailbox.get()
+            key = ChangeFilter.canonical(**activity)
+            if self.coalescer.pending is None and not self.filter.is_new(key):
+                continue
+            self.coalescer.offer(activity)
+            # Keep taking newer samples while the rate limit or debounce holds us back.
+            delay = self.coalescer.deadline()
+            while delay:
+                try:
+                    activity = await asyncio.wait_for(self.mailbox.get(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                else:
+                    self.coalescer.offer(activity)
+                delay = self.coalescer.deadline()
+            key = ChangeFilter.canonical(**self.coalescer.pending)
+            if not self.filter.is_new(key):
+                self.coalescer.discard()
+                continue
+            await self._connected.wait()
+            activity = self.coalescer.take()
+            try:
+                await self.presence.update(**activity)
+            except ServerError:
+                # Discord rejected this activity; resending it won't help.
+                pass
+            except CONNECTION_ERRORS + (ResponseTimeout,):
+                # Not sent: the supervisor only replays what Discord last accepted, so keep this
+                # one for after the reconnect unless the poller has already put something newer.
+                self._connected.clear()
+                self._lost.set()
+                if self.mailbox.empty():
+                    self.mailbox.put(activity)
+                continue
+            self.filter.record(key)
+
+    async def _supervisor(self):
+        if self.broadcast:
+            self.presence = MultiPresence(self.client_id, **self.presence_kwargs)
+        else:
+            self.presence = AioPresence(self.client_id, pipe=self.pipe, **self.presence_kwargs)
+        while True:
+            self._connected.clear()
+            try:
+                await self.presence.reconnect()
+            except ServerError:
+                pass
+            except CONNECTION_ERRORS:
+                continue
+            self._lost.clear()
+            self._connected.set()
+            while not self._lost.is_set():
+                try:
+                    await asyncio.wait_for(self._lost.wait(), self.ping_interval)
+                except asyncio.TimeoutError:
+                    try:
+                        await self.presence.keepalive(self.ping_interval)
+                    except CONNECTION_ERRORS:
+                        break
@@ -0,0 +1,193 @@
+"""Event dispatch for Client and AioClient.
+
+DISPATCH frames are queued as they are decoded and handed to ``client.on_event``
+off the reader: on a thread pool for the sync Client, as tasks for AioClient.
+A slow handler only holds up its own worker, never the pipe.
+"""
+import asyncio
+import bisect
+import inspect
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from exceptions import InvalidArgument
+
+
+class Histogram:
+    """Handler latencies in fixed buckets, in seconds."""
+    BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the bucket holding the ``q``-th percentile (the max for the overflow bucket)."""
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def __repr__(self):
+        mean = self.total / self.count if self.count else 0.0
+        return '<Histogram count={0} mean={1:.4f} p50={2} p99={3} max={4:.4f}>'.format(
+            self.count, mean, self.percentile(50), self.percentile(99), self.max)
+
+
+class EventStats:
+    __slots__ = ('received', 'handled', 'failed', 'dropped', 'latency')
+
+    def __init__(self):
+        self.received = 0
+        self.handled = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency = Histogram()
+
+    def __repr__(self):
+        return '<EventStats received={0} handled={1} failed={2} dropped={3} latency={4!r}>'.format(
+            self.received, self.handled, self.failed, self.dropped, self.latency)
+
+
+class EventDispatcher:
+    """Queues events for ``client.on_event`` and runs up to ``workers`` handlers at once.
+
+    With ``ordered``, events of the same type are handled one at a time in the
+    order they arrived; different types still run side by side. ``overflow``
+    decides what happens once ``maxsize`` events are waiting:
+
+    * ``'drop_oldest'`` evicts the oldest queued event,
+    * ``'shed'`` drops the incoming one,
+    * ``'block'`` stops reading from the pipe until there is room again (replies wait too).
+
+    Dropped events are counted per type. Handler exceptions go to ``client.report_error``.
+    """
+    POLICIES = ('drop_oldest', 'shed', 'block')
+
+    def __init__(self, client, maxsize: int = 256, workers: int = 4, ordered: bool = False,
+                 overflow: str = 'drop_oldest'):
+        if overflow not in self.POLICIES:
+            raise InvalidArgument(' or '.join(self.POLICIES), overflow)
+        self.client = client
+        self.maxsize = maxsize
+        self.workers = workers
+        self.ordered = ordered
+        self.overflow = overflow
+        self.stats = {}
+        self.queue = None  # type: asyncio.Queue
+        self._executor = None  # type: ThreadPoolExecutor
+        self._slots = None  # type: asyncio.Semaphore
+        self._runner = None  # type: asyncio.Task
+        self._blocked = deque()
+        self._tails = {}
+
+    def _stats(self, evt: str) -> EventStats:
+        stats = self.stats.get(evt)
+        if stats is None:
+            stats = self.stats[evt] = EventStats()
+        return stats
+
+    def start(self, loop):
+        if self._runner is not None and not self._runner.done():
+            return
+        if not self.client.isasync and self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='events')
+        self.queue = asyncio.Queue(self.maxsize)
+        self._slots = asyncio.Semaphore(self.workers)
+        self._runner = loop.create_task(self._run())
+
+    def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def put(self, payload: dict):
+        """Called on the loop for each DISPATCH frame. Never blocks the reader."""
+        self._stats(payload['evt']).received += 1
+        if self._blocked or self.queue.full():
+            if self.overflow == 'shed':
+                self._stats(payload['evt']).dropped += 1
+                return
+            if self.overflow == 'block':
+                # Frames already decoded from the last read wait here; nothing more is read meanwhile.
+                if not self._blocked and self.client.sock_writer is not None:
+                    self.client.sock_writer.pause_reading()
+                self._blocked.append(payload)
+                return
+            dropped = self.queue.get_nowait()
+            self._stats(dropped['evt']).dropped += 1
+        self.queue.put_nowait(payload)
+
+    def _unblock(self):
+        while self._blocked and not self.queue.full():
+            self.queue.put_nowait(self._blocked.popleft())
+        if not self._blocked and self.client.sock_writer is not None and not self.client.sock_writer.is_reading():
+            self.client.sock_writer.resume_reading()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            payload = await self.queue.get()
+            if self._blocked:
+                self._unblock()
+            await self._slots.acquire()
+            evt = payload['evt']
+            # A handler waiting on its predecessor holds its slot, so ordering never exceeds ``workers``.
+            previous = self._tails.get(evt) if self.ordered else None
+            task = loop.create_task(self._handle(payload, previous))
+            if self.ordered:
+                self._tails[evt] = task
+            task.add_done_callback(lambda task, evt=evt: self._done(evt, task))
+
+    async def _handle(self, payload: dict, previous: asyncio.Task):
+        if previous is not None:
+            await asyncio.wait((previous,))
+        # Stats are only touched here, on the loop, never from the handler threads.
+        stats = self._stats(payload['evt'])
+        started = time.perf_counter()
+        try:
+            if self._executor is not None:
+                await asyncio.get_running_loop().run_in_executor(self._executor, self._call, payload)
+            else:
+                await self._call_async(payload)
+        except BaseException:
+            stats.failed += 1
+            raise
+        else:
+            stats.handled += 1
+        finally:
+            stats.latency.observe(time.perf_counter() - started)
+
+    def _done(self, evt: str, task):
+        self._slots.release()
+        if self._tails.get(evt) is task:
+            del self._tails[evt]
+        if not task.cancelled() and task.exception() is not None:
+            self.client.report_error(task.exception(), task)
+
+    def _call(self, payload: dict):
+        result = self.client.on_event(payload)
+        if inspect.isawaitable(result):
+            asyncio.run_coroutine_threadsafe(result, self.client.loop).result()
+
+    async def _call_async(self, payload: dict):
+        result = self.client.on_event(payload)
+        if inspect.isawaitable(result):
+            await result
@@ -26,6 +26,12 @@ class ServerError(PyPresenceException):
         super().__init__(message.replace(']', '').replace('[', '').capitalize())
 
 
+class ResponseTimeout(PyPresenceException):
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        super().__init__('Discord did not reply within {0}s'.format(timeout))
+
+
 class DiscordError(PyPresenceException):
     def __init__(self, code: int, message: str):
         self.code = code
@@ -0,0 +1,227 @@
+"""Low-level IPC plumbing: frame decoding, the transport protocol, and finding
+and opening Discord's IPC endpoints."""
+import asyncio
+import os
+import struct
+import sys
+import tempfile
+from typing import TYPE_CHECKING
+
+from exceptions import InvalidID, InvalidPipe
+
+if TYPE_CHECKING:
+    from baseclient import BaseClient
+
+OP_HANDSHAKE = 0
+OP_FRAME = 1
+OP_CLOSE = 2
+OP_PING = 3
+OP_PONG = 4
+
+_HEADER = struct.Struct('<II')
+
+
+class FrameDecoder:
+    """Incremental decoder for IPC frames: a ``<II`` op/length header followed by the body.
+
+    ``on_frame(op, body)`` is called for every complete frame with a memoryview of
+    the body that is only valid for the duration of the call. Chunks holding whole
+    frames are parsed in place; only a trailing partial frame is buffered.
+    """
+
+    def __init__(self, on_frame):
+        self._on_frame = on_frame
+        self._buffer = bytearray()
+
+    def _parse(self, data) -> int:
+        pos = 0
+        size = len(data)
+        with memoryview(data) as view:
+            while size - pos >= 8:
+                op, length = _HEADER.unpack_from(view, pos)
+                end = pos + 8 + length
+                if end > size:
+                    break
+                self._on_frame(op, view[pos + 8:end])
+                pos = end
+        return pos
+
+    def feed(self, data: bytes):
+        if self._buffer:
+            self._buffer += data
+            del self._buffer[:self._parse(self._buffer)]
+        else:
+            consumed = self._parse(data)
+            if consumed < len(data):
+                self._buffer += memoryview(data)[consumed:]
+
+    def reset(self):
+        self._buffer = bytearray()
+
+
+class IPCProtocol(asyncio.Protocol):
+    def __init__(self, client: 'BaseClient'):
+        self.client = client
+        self.transport = None
+        self.decoder = FrameDecoder(client._on_frame)
+        self._paused = False
+        self._drain_waiters = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.client.write_high, low=self.client.write_low)
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+
+    def eof_received(self):
+        return False
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake_drainers(None)
+
+    def _wake_drainers(self, exc):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                if exc is None:
+                    waiter.set_result(None)
+                else:
+                    waiter.set_exception(exc)
+
+    async def drain(self):
+        """Wait until the transport's write buffer is back under the low watermark."""
+        while self._paused:
+            waiter = self.client.loop.create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionResetError('Pipe closed')
+
+    def connection_lost(self, exc):
+        self._wake_drainers(exc or ConnectionResetError('Discord closed the pipe'))
+        self.client._on_connection_lost(self, exc)
+
+
+def _unix_dirs():
+    tempdir = (os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir())
+    return [
+        '{0}/snap.discord'.format(tempdir),
+        '{0}/app/com.discordapp.Discord'.format(tempdir),
+        '{0}/app/com.discordapp.DiscordCanary'.format(tempdir),
+        tempdir,
+    ]
+
+
+def ipc_path(pipe: int) -> str:
+    if sys.platform == 'linux' or sys.platform == 'darwin':
+        dirs = _unix_dirs()
+        # The first sandbox directory that exists, else the plain temp dir (always last).
+        directory = next((d for d in dirs[:-1] if os.path.isdir(d)), dirs[-1])
+        return '{0}/discord-ipc-{1}'.format(directory, pipe)
+    elif sys.platform == 'win32':
+        return r'\\?\pipe\discord-ipc-' + str(pipe)
+
+
+def candidate_paths(pipes=range(10)) -> list:
+    """Every endpoint a Discord client could be listening on (pipes 0-9 in each location)."""
+    if sys.platform == 'win32':
+        return [ipc_path(pipe) for pipe in pipes]
+    paths = []
+    for directory in _unix_dirs():
+        for pipe in pipes:
+            path = '{0}/discord-ipc-{1}'.format(directory, pipe)
+            if os.path.exists(path):
+                paths.append(path)
+    return paths
+
+
+class _HandshakeProtocol(asyncio.Protocol):
+    """Sends the handshake and waits for READY; the winning transport is then handed over
+    to an IPCProtocol with ``transport.set_protocol``."""
+
+    def __init__(self, loop, client_id: str, codec):
+        self.codec = codec
+        self.client_id = client_id
+        self.ready = loop.create_future()
+        self.decoder = FrameDecoder(self._on_frame)
+
+    def connection_made(self, transport):
+        body = self.codec.dumps({'v': 1, 'client_id': self.client_id})
+        transport.writelines((_HEADER.pack(OP_HANDSHAKE, len(body)), body))
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+
+    def _on_frame(self, op: int, body: memoryview):
+        if self.ready.done():
+            return
+        if op == OP_CLOSE:
+            self.ready.set_exception(InvalidID())
+        else:
+            self.ready.set_result(self.codec.loads(body))
+
+    def connection_lost(self, exc):
+        if not self.ready.done():
+            self.ready.set_exception(exc or ConnectionResetError('Discord closed the pipe'))
+
+
+async def connect(loop, path: str, client_id: str, codec, timeout: float = None):
+    """Open ``path`` and complete the handshake. Returns ``(path, transport, ready_payload)``."""
+    protocol = _HandshakeProtocol(loop, client_id, codec)
+
+    async def handshake():
+        # Made in here so a probe cancelled before it starts leaves no coroutine unawaited.
+        if sys.platform == 'linux' or sys.platform == 'darwin':
+            connecting = loop.create_unix_connection(lambda: protocol, path)
+        elif sys.platform == 'win32' or sys.platform == 'win64':
+            connecting = loop.create_pipe_connection(lambda: protocol, path)
+        try:
+            transport, _ = await connecting
+        except FileNotFoundError:
+            if sys.platform == 'win32':
+                raise InvalidPipe
+            raise
+        try:
+            return path, transport, await protocol.ready
+        except BaseException:
+            transport.close()
+            raise
+
+    return await asyncio.wait_for(handshake(), timeout)
+
+
+async def discover(loop, client_id: str, codec, timeout: float = 1.0, preferred: str = None):
+    """Probe every candidate endpoint at once and keep the first one to finish a handshake.
+
+    ``preferred`` (usually the last winner) is tried on its own first.
+    """
+    if preferred:
+        try:
+            return await connect(loop, preferred, client_id, codec, timeout)
+        except (OSError, InvalidPipe, InvalidID, asyncio.TimeoutError):
+            pass
+
+    probes = [asyncio.ensure_future(connect(loop, path, client_id, codec, timeout))
+              for path in candidate_paths() if path != preferred]
+    winner = None
+    try:
+        for probe in asyncio.as_completed(probes):
+            try:
+                winner = await probe
+            except (OSError, InvalidPipe, InvalidID, asyncio.TimeoutError):
+                continue
+            break
+    finally:
+        for probe in probes:
+            probe.cancel()
+        for result in await asyncio.gather(*probes, return_exceptions=True):
+            if isinstance(result, tuple) and result is not winner:
+                result[1].close()
+    if winner is None:
+        raise InvalidPipe
+    return winner
@@ -1,14 +1,19 @@
 import wmi
 import presence
-import win32com.client
-import time
-import datetime
+import asyncio
+import sys
 import os
 import win10toast
+from baseclient import CONNECTION_ERRORS
+from daemon import Daemon
+from exceptions import ResponseTimeout, ServerError
+from nowplaying import NowPlaying
+from player import PlayerSource
+from scheduler import Scheduler
+from state import StateJournal, atomic_write
 
-f = open('.pid', 'w')
-f.write(str(os.getpid()))
-f.close()
+atomic_write('.pid', str(os.getpid()))
+journal = StateJournal()
 
 toaster = win10toast.ToastNotifier()
 
@@ -18,69 +23,51 @@ for process in wmi.WMI().Win32_Process():
     processes.append(process.Name)
 
 client_id = '878589532398846023'
-RPC = presence.Presence(client_id, pipe=0)
+nowplaying = NowPlaying(journal)
+
+if '--daemon' in sys.argv:
+    # Connection failures are retried by the daemon's supervisor instead of exiting.
+    if 'iTunes.exe' in processes:
+        toaster.show_toast("iTunesRPC", "Successfully Started!", icon_path="icon.ico", duration=3)
+        if '--broadcast' in sys.argv:
+            # Drive every Discord build that's running (stable, PTB, Canary) at once.
+            daemon = Daemon(client_id, PlayerSource.itunes, nowplaying, broadcast=True)
+        else:
+            daemon = Daemon(client_id, PlayerSource.itunes, nowplaying, pipe=None, ipc_cache=journal)
+        asyncio.run(daemon.run())
+    os.sys.exit()
+
+RPC = presence.Presence(client_id, pipe=None, ipc_cache=journal, reconnect=True, fast_acks=True,
+                        validate='truncate')
+coalescer = presence.Coalescer(RPC)
+activity = presence.ChangeFilter(coalescer)
 try:
    RPC.connect()
 except:
-    toaster.show_toast("iTunesRPC", "Error: Discord Not Found.", icon_path="icon.ico", duration=3)
-    time.sleep(3)
-    os.sys.exit()
-
-def get_sec(time_str):
-    h, m, s = time_str.split(':')
-    return int(h) * 3600 + int(m) * 60 + int(s)
-
-oldsong = ''
-wasPaused = False
+    toaster.show_toast("iTunesRPC", "Discord Not Found. Waiting for it to start...", icon_path="icon.ico", duration=3)
+    RPC.reconnect()
 
 if 'iTunes.exe' in processes:
-    itunes = win32com.client.Dispatch('iTunes.Application')
+    player = PlayerSource.itunes()
+    scheduler = Scheduler()
     toaster.show_toast("iTunesRPC", "Successfully Started!", icon_path="icon.ico", duration=3)
 
-    while True:
-        if itunes.currentTrack == None:
-            RPC.update(details="Not Playing", large_image="icon")
-
-        else:
-            if itunes.playerState == 0:
-                wasPaused = True
-                song = itunes.currentTrack.name
-                artist = itunes.currentTrack.artist
-    
-                RPC.update(details=f"Paused", state=f"{song} by {artist}", large_image="icon")
-    
-            else:
-                if wasPaused == True:
-                    wasPaused = False
-                    song = itunes.currentTrack.name
-                    artist = itunes.currentTrack.artist
-                    album = itunes.currentTrack.album
-                    current_time = int(time.time())
-                    songtime = get_sec('0:' + itunes.currentTrack.time)
-                    current_pos = int(itunes.playerPosition)
-                    end_time = current_time + (songtime - current_pos)
-    
-                    RPC.update(details=f"{song} by {artist}", state=f'from {album}', large_image="icon", start=current_time, end=end_time)
-    
-                else:    
-                    song = itunes.currentTrack.name
-                    artist = itunes.currentTrack.artist
-                    album = itunes.currentTrack.album
-                    timeElapsed = datetime.timedelta(seconds=itunes.playerPosition)
-                    timeFinish = get_sec('0:' + itunes.currentTrack.time)
-                    startTime = int(time.time()) - int(itunes.playerPosition)
-            
-                    if oldsong == song:
-                        f = open('.end', 'r')
-                        endTime = int(f.read())
-                        f.close()
-                    else:
-                        oldsong = song
-                        f = open('.end', 'w')
-                        endTime = startTime + timeFinish
-                        f.write(str(endTime))
-                        f.close()
-    
-                    RPC.update(details=f"{song} by {artist}", state=f'from {album}', large_image="icon", start=startTime, end=endTime)
-    
-        time.sleep(15)
+    while scheduler.running:
+        track = player.snapshot()
+        delay = scheduler.next_delay(track)
+        try:
+            activity.update(**nowplaying.render(track))
+            RPC.keepalive()
+            # Flush a rate-limited update as soon as the budget allows instead of on the next poll.
+            while coalescer.pending is not None and coalescer.deadline() < delay:
+                flush_in = coalescer.deadline()
+                scheduler.wait(flush_in)
+                activity.flush()
+                delay -= flush_in
+        except CONNECTION_ERRORS + (ResponseTimeout,):
+            # Discord went away, or holds the pipe open but stopped answering; start over on a fresh one.
+            RPC.reconnect()
+        except ServerError:
+            # Discord rejected the activity. It was never recorded as sent, so the next poll tries again.
+            pass
+        scheduler.wait(delay)
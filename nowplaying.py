@@ -0,0 +1,49 @@
+"""Turns player snapshots into presence update arguments."""
+from payloads import Activity
+from player import TrackSnapshot
+from state import StateJournal
+
+
+class NowPlaying:
+    def __init__(self, journal: StateJournal):
+        self.journal = journal
+        # Restored from the journal so a restart mid-song keeps the original end time.
+        self.track_id = tuple(journal.get('track') or ())
+        self.start = journal.get('start', 0)
+        self.end = journal.get('end', 0)
+        self.was_paused = False
+
+    def render(self, track: TrackSnapshot = None) -> dict:
+        if track is None:
+            return dict(activity=Activity(details="Not Playing", large_image="icon"))
+
+        song = track.name
+        artist = track.artist
+
+        if track.paused:
+            self.was_paused = True
+            return dict(activity=Activity(details="Paused", state=f"{song} by {artist}", large_image="icon"))
+
+        album = track.album
+
+        if self.was_paused:
+            self.was_paused = False
+            current_time = int(track.taken_at)
+            end_time = current_time + (track.duration - track.position)
+            return dict(activity=Activity(details=f"{song} by {artist}", state=f'from {album}', large_image="icon",
+                                          start=current_time, end=end_time))
+
+        start = int(track.taken_at) - track.position
+
+        # Position is only reported in whole seconds; don't resend for rounding jitter.
+        # A bigger jump on the same track is a replay or a seek.
+        if self.track_id == track.track_id and abs(start - self.start) <= 2:
+            start = self.start
+        else:
+            self.track_id = track.track_id
+            self.end = start + track.duration
+            self.journal.update(track=list(track.track_id), start=start, end=self.end)
+
+        self.start = start
+        return dict(activity=Activity(details=f"{song} by {artist}", state=f'from {album}', large_image="icon",
+                                      start=start, end=self.end))
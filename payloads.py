@@ -1,17 +1,272 @@
+import itertools
 import json
 import os
+import threading
 import time
 from typing import List, Union
 
-from utils import remove_none
+from exceptions import InvalidArgument
+from utils import LRUCache, _payload_gen, _payload_tree, remove_none
+
+_nonces = itertools.count(1)
+
+_ACTIVITY_STATIC = {"cmd": "SET_ACTIVITY"}
+_ACTIVITY_PATHS = (
+    ("args", "pid"),
+    ("args", "activity", "state"),
+    ("args", "activity", "details"),
+    ("args", "activity", "timestamps", "start"),
+    ("args", "activity", "timestamps", "end"),
+    ("args", "activity", "assets", "large_image"),
+    ("args", "activity", "assets", "large_text"),
+    ("args", "activity", "assets", "small_image"),
+    ("args", "activity", "assets", "small_text"),
+    ("args", "activity", "party", "id"),
+    ("args", "activity", "party", "size"),
+    ("args", "activity", "secrets", "join"),
+    ("args", "activity", "secrets", "spectate"),
+    ("args", "activity", "secrets", "match"),
+    ("args", "activity", "buttons"),
+    ("args", "activity", "instance"),
+    ("nonce",),
+)
+_ACTIVITY_FIELDS = ('state', 'details', 'start', 'end', 'large_image', 'large_text', 'small_image', 'small_text',
+                    'party_id', 'party_size', 'join', 'spectate', 'match', 'buttons', 'instance')
+_FIELD_PATHS = dict(zip(_ACTIVITY_FIELDS, _ACTIVITY_PATHS[1:-1]))
+_PATH_FIELDS = dict(zip(_ACTIVITY_PATHS[1:-1], _ACTIVITY_FIELDS))
+# Bit 0 is pid in the SET_ACTIVITY shape, so activity fields start at bit 1.
+_FIELD_BITS = tuple(zip(_ACTIVITY_PATHS[1:-1], (1 << bit for bit in range(1, len(_ACTIVITY_PATHS) - 1))))
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+class Activity:
+    """An immutable rich presence activity.
+
+    Only the fields that are set are stored, already in wire order, so it renders
+    straight into the SET_ACTIVITY template. Equal activities compare and hash
+    alike, which is what presence.ChangeFilter and Coalescer rely on.
+    """
+    __slots__ = ('_fields', '_shape', '_hash')
+
+    def __init__(self, state: str = None, details: str = None,
+                 start: int = None, end: int = None,
+                 large_image: str = None, large_text: str = None,
+                 small_image: str = None, small_text: str = None,
+                 party_id: str = None, party_size: list = None,
+                 join: str = None, spectate: str = None,
+                 match: str = None, buttons: list = None,
+                 instance: bool = True):
+        if start and type(start) is not int:
+            start = int(start)
+        if end and type(end) is not int:
+            end = int(end)
+        # Copied so a caller mutating its own list can't change a sent activity.
+        if party_size is not None:
+            party_size = list(party_size)
+        if buttons is not None:
+            buttons = [dict(button) for button in buttons]
+        values = (state, details, start, end, large_image, large_text, small_image, small_text,
+                  party_id, party_size, join, spectate, match, buttons, instance)
+        fields = []
+        shape = 0
+        for (path, bit), value in zip(_FIELD_BITS, values):
+            if value is not None:
+                fields.append((path, value))
+                shape |= bit
+        _set = object.__setattr__
+        _set(self, '_fields', tuple(fields))
+        _set(self, '_shape', shape)
+        _set(self, '_hash', None)
+
+    def __getattr__(self, name):
+        path = _FIELD_PATHS.get(name)
+        if path is None:
+            raise AttributeError(name)
+        for field_path, value in self._fields:
+            if field_path is path:
+                return value
+        return None
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Activity is immutable')
+
+    def __delattr__(self, key):
+        raise AttributeError('Activity is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, Activity):
+            return NotImplemented
+        return self._shape == other._shape and self._fields == other._fields
+
+    def __hash__(self):
+        if self._hash is None:
+            # The shape already says which paths are set, so only the values are hashed.
+            values = tuple(value if type(value) is not list else _hashable(value) for _, value in self._fields)
+            object.__setattr__(self, '_hash', hash((self._shape, values)))
+        return self._hash
+
+    def __repr__(self):
+        return '<Activity {0}>'.format(' '.join('{0}={1!r}'.format(_PATH_FIELDS[path], value)
+                                               for path, value in self._fields))
+
+    def replace(self, **changes):
+        """A copy with ``changes`` applied; pass None to unset a field."""
+        values = {name: getattr(self, name) for name in _ACTIVITY_FIELDS}
+        values.update(changes)
+        return Activity(**values)
+
+    def to_dict(self) -> dict:
+        return _payload_tree({}, self._fields)['args']['activity'] if self._fields else {}
+
+
+# Discord's limits for an activity, in characters.
+_TEXT_LIMITS = {'state': 128, 'details': 128, 'large_text': 128, 'small_text': 128,
+                'large_image': 256, 'small_image': 256, 'party_id': 128,
+                'join': 128, 'spectate': 128, 'match': 128}
+_MAX_BUTTONS = 2
+_LABEL_LIMIT = 32
+_URL_LIMIT = 512
+_DROP = object()
+
+
+def _clip(text: str, limit: int) -> str:
+    return text[:limit - 1] + '\u2026'
+
+
+class ActivityValidator:
+    """Checks an Activity against Discord's limits before it goes out, so a bad one never costs a round trip.
+
+    In ``'truncate'`` mode long strings are cut (ending in an ellipsis), buttons past
+    the second are dropped and a malformed party size is left out. In ``'strict'`` mode
+    any of those raises InvalidArgument. Results are cached per Activity, so an
+    activity that is sent again is only looked up.
+    """
+
+    def __init__(self, mode: str = 'truncate', cache_size: int = 256):
+        if mode not in ('truncate', 'strict'):
+            raise InvalidArgument('truncate or strict', mode)
+        self.mode = mode
+        self.cache = LRUCache(cache_size)
+        # The sync clients validate on the caller's thread, and there may be several.
+        self._lock = threading.Lock()
+        self.fixed = 0
+        self.rejected = 0
+        rules = {_FIELD_PATHS[name]: (name, self._text(limit)) for name, limit in _TEXT_LIMITS.items()}
+        rules[_FIELD_PATHS['party_size']] = ('party_size', self._party_size)
+        rules[_FIELD_PATHS['buttons']] = ('buttons', self._buttons)
+        self._rules = rules
+
+    @staticmethod
+    def _text(limit: int):
+        def check(value):
+            if not isinstance(value, str):
+                return _DROP, 'a string'
+            if len(value) > limit:
+                return _clip(value, limit), 'at most {0} characters'.format(limit)
+            return value, None
+        return check
+
+    @staticmethod
+    def _party_size(value):
+        if len(value) == 2 and all(type(n) is int for n in value) and 0 < value[0] <= value[1]:
+            return value, None
+        return _DROP, '[current, max] with 0 < current <= max'
+
+    @staticmethod
+    def _buttons(value):
+        buttons, problem = [], None
+        for button in value[:_MAX_BUTTONS]:
+            label, url = button.get('label'), button.get('url')
+            if not isinstance(label, str) or not isinstance(url, str) or len(url) > _URL_LIMIT:
+                problem = 'a label and a url of at most {0} characters'.format(_URL_LIMIT)
+                continue
+            if len(label) > _LABEL_LIMIT:
+                problem = 'labels of at most {0} characters'.format(_LABEL_LIMIT)
+                label = _clip(label, _LABEL_LIMIT)
+            buttons.append({'label': label, 'url': url})
+        if len(value) > _MAX_BUTTONS:
+            problem = 'at most {0} buttons'.format(_MAX_BUTTONS)
+        if problem is None:
+            return value, None
+        return buttons or _DROP, problem
+
+    def _check(self, activity: Activity):
+        changes = {}
+        for path, value in activity._fields:
+            rule = self._rules.get(path)
+            if rule is None:
+                continue
+            name, check = rule
+            fixed, problem = check(value)
+            if problem is None:
+                continue
+            if self.mode == 'strict':
+                received = '{0} characters'.format(len(value)) if isinstance(value, str) else repr(value)
+                # The arguments, not the exception: a cached exception would collect a traceback per raise.
+                return problem, received, 'Discord would reject this {0}.'.format(name)
+            changes[name] = None if fixed is _DROP else fixed
+        if not changes:
+            return activity
+        return activity.replace(**changes)
+
+    def __call__(self, activity: Activity) -> Activity:
+        with self._lock:
+            result = self.cache.get(activity)
+            if result is None:
+                result = self._check(activity)
+                self.cache.put(activity, result)
+                if isinstance(result, tuple):
+                    self.rejected += 1
+                elif result is not activity:
+                    self.fixed += 1
+        if isinstance(result, tuple):
+            raise InvalidArgument(*result)
+        return result
 
 
 class Payload:
 
-    def __init__(self, data, clear_none=True):
-        if clear_none:
-            data = remove_none(data)
-        self.data = data
+    def __init__(self, data, clear_none=True, template=None):
+        """``template`` is ``(payload_type, static, shape, fields)`` for payloads rendered
+        through utils._payload_gen; ``data`` is then only built if someone asks for it."""
+        if template is not None:
+            payload_type, static, shape, fields = template
+            self._data = None
+            self.cmd = static.get("cmd")
+            self.request_nonce = fields[-1][1] if fields and fields[-1][0] == ("nonce",) else None
+        else:
+            if clear_none:
+                data = remove_none(data)
+            self._data = data
+            self.cmd = data.get("cmd")
+            self.request_nonce = data.get("nonce")
+        self._template = template
+        self._encoded = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            _, static, _, fields = self._template
+            self._data = _payload_tree(static, fields)
+        return self._data
+
+    def encode(self, codec) -> bytes:
+        # Remembered so a payload broadcast to several connections is only encoded once.
+        if self._encoded is not None and self._encoded[0] is codec:
+            return self._encoded[1]
+        if self._template is None:
+            data = codec.dumps(self.data)
+        else:
+            data = _payload_gen(*self._template, codec)
+        self._encoded = (codec, data)
+        return data
 
     def __str__(self):
         return json.dumps(self.data, indent=2)
@@ -20,6 +275,11 @@ class Payload:
     def time():
         return time.time()
 
+    @staticmethod
+    def nonce() -> str:
+        # Replies are matched to requests by nonce, so it must never repeat within a process.
+        return str(next(_nonces))
+
     @classmethod
     def set_activity(cls, pid: int = os.getpid(),
                      state: str = None, details: str = None,
@@ -39,36 +299,49 @@ class Payload:
         if end:
             end = int(end)
 
-        if activity is None:
-            act_details = None
-            clear = True
-        else:
-            act_details = {
-                    "state": state,
-                    "details": details,
-                    "timestamps": {
-                        "start": start,
-                        "end": end
-                    },
-                    "assets": {
-                        "large_image": large_image,
-                        "large_text": large_text,
-                        "small_image": small_image,
-                        "small_text": small_text
-                    },
-                    "party": {
-                        "id": party_id,
-                        "size": party_size
-                    },
-                    "secrets": {
-                        "join": join,
-                        "spectate": spectate,
-                        "match": match
-                    },
-                    "buttons": buttons,
-                    "instance": instance
-                }
-            clear = False
+        if _rn or activity is None:
+            # Nones are dropped anyway, so render from the compiled template instead of
+            # building the nested dict and stripping it with remove_none.
+            if activity is None:
+                values = (pid, cls.nonce())
+                paths = (_ACTIVITY_PATHS[0], _ACTIVITY_PATHS[-1])
+            else:
+                values = (pid, state, details, start, end, large_image, large_text, small_image, small_text,
+                          party_id, party_size, join, spectate, match, buttons, instance, cls.nonce())
+                paths = _ACTIVITY_PATHS
+            fields = []
+            shape = 0
+            for bit, (path, value) in enumerate(zip(paths, values)):
+                if value is not None:
+                    fields.append((path, value))
+                    shape |= 1 << bit
+            return cls(None, template=("SET_ACTIVITY", _ACTIVITY_STATIC, (activity is None, shape), fields))
+
+        act_details = {
+                "state": state,
+                "details": details,
+                "timestamps": {
+                    "start": start,
+                    "end": end
+                },
+                "assets": {
+                    "large_image": large_image,
+                    "large_text": large_text,
+                    "small_image": small_image,
+                    "small_text": small_text
+                },
+                "party": {
+                    "id": party_id,
+                    "size": party_size
+                },
+                "secrets": {
+                    "join": join,
+                    "spectate": spectate,
+                    "match": match
+                },
+                "buttons": buttons,
+                "instance": instance
+            }
 
         payload = {
             "cmd": "SET_ACTIVITY",
@@ -76,11 +349,18 @@ class Payload:
                 "pid": pid,
                 "activity": act_details
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
-        if _rn:
-            clear = _rn
-        return cls(payload, clear)
+        return cls(payload, False)
+
+    @classmethod
+    def from_activity(cls, activity: Activity, pid: int = os.getpid()):
+        """SET_ACTIVITY for an Activity; renders through the same template as set_activity."""
+        fields = [(_ACTIVITY_PATHS[0], pid)]
+        fields.extend(activity._fields)
+        fields.append((_ACTIVITY_PATHS[-1], cls.nonce()))
+        shape = activity._shape | 1 | 1 << (len(_ACTIVITY_PATHS) - 1)
+        return cls(None, template=("SET_ACTIVITY", _ACTIVITY_STATIC, (False, shape), fields))
 
     @classmethod
     def authorize(cls, client_id: str, scopes: List[str]):
@@ -90,7 +370,7 @@ class Payload:
                 "client_id": str(client_id),
                 "scopes": scopes
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
         return cls(payload)
 
@@ -101,7 +381,7 @@ class Payload:
             "args": {
                 "access_token": token
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -112,7 +392,7 @@ class Payload:
             "cmd": "GET_GUILDS",
             "args": {
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -124,7 +404,7 @@ class Payload:
             "args": {
                 "guild_id": str(guild_id),
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -136,7 +416,7 @@ class Payload:
             "args": {
                 "guild_id": str(guild_id),
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -148,7 +428,7 @@ class Payload:
             "args": {
                 "channel_id": str(channel_id),
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -168,7 +448,7 @@ class Payload:
                 "volume": volume,
                 "mute": mute
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload, True)
@@ -180,7 +460,7 @@ class Payload:
             "args": {
                 "channel_id": str(channel_id),
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -191,7 +471,7 @@ class Payload:
             "cmd": "GET_SELECTED_VOICE_CHANNEL",
             "args": {
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -203,7 +483,7 @@ class Payload:
             "args": {
                 "channel_id": str(channel_id),
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -214,7 +494,7 @@ class Payload:
             "cmd": "SUBSCRIBE",
             "args": args,
             "evt": event.upper(),
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -225,7 +505,7 @@ class Payload:
             "cmd": "UNSUBSCRIBE",
             "args": args,
             "evt": event.upper(),
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -236,7 +516,7 @@ class Payload:
             "cmd": "GET_VOICE_SETTINGS",
             "args": {
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -261,7 +541,7 @@ class Payload:
                 "deaf": deaf,
                 "mute": mute
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload, True)
@@ -273,7 +553,7 @@ class Payload:
             "args": {
                 "action": action.upper()
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -285,7 +565,7 @@ class Payload:
             "args": {
                 "user_id": str(user_id)
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
@@ -297,7 +577,7 @@ class Payload:
             "args": {
                 "user_id": str(user_id)
             },
-            "nonce": '{:.20f}'.format(cls.time())
+            "nonce": cls.nonce()
         }
 
         return cls(payload)
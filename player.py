@@ -0,0 +1,157 @@
+"""Player sources for the iTunes poll loop.
+
+Everything the loop needs from iTunes is read once per tick into a
+TrackSnapshot, so each tick only pays for one ``currentTrack`` proxy.
+Tracks are identified by their iTunes persistent ID, and metadata that
+never changes for a track is only fetched the first time it is seen.
+"""
+import itertools
+import time
+
+from utils import LRUCache
+
+
+def get_sec(time_str):
+    h, m, s = time_str.split(':')
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+
+class TrackSnapshot:
+    __slots__ = ('track_id', 'name', 'artist', 'album', 'time', 'duration', 'state', 'position', 'taken_at')
+
+    def __init__(self, track_id: tuple, name: str, artist: str, album: str, time: str,
+                 duration: int, state: int, position: int, taken_at: float):
+        _set = object.__setattr__
+        _set(self, 'track_id', track_id)
+        _set(self, 'name', name)
+        _set(self, 'artist', artist)
+        _set(self, 'album', album)
+        _set(self, 'time', time)
+        _set(self, 'duration', duration)
+        _set(self, 'state', state)
+        _set(self, 'position', position)
+        _set(self, 'taken_at', taken_at)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('TrackSnapshot is immutable')
+
+    def __delattr__(self, key):
+        raise AttributeError('TrackSnapshot is immutable')
+
+    def __repr__(self):
+        return '<TrackSnapshot {0!r} by {1!r} state={2} position={3}/{4}>'.format(
+            self.name, self.artist, self.state, self.position, self.duration)
+
+    @property
+    def paused(self):
+        return self.state == 0
+
+
+class PlayerSource:
+    """Reads one TrackSnapshot per tick from an iTunes-like application object.
+
+    ``app`` is either the ``iTunes.Application`` COM dispatch or a FakeApplication.
+    Every attribute read on ``app`` or its track is counted in ``calls``.
+    """
+
+    def __init__(self, app, clock=time.time, cache_size: int = 256):
+        self._app = app
+        self._clock = clock
+        self.metadata = LRUCache(cache_size)
+        self.calls = 0
+        self.last_calls = 0
+        self.total_calls = 0
+
+    @classmethod
+    def itunes(cls):
+        import win32com.client
+        return cls(win32com.client.Dispatch('iTunes.Application'))
+
+    def _read(self, obj, attr):
+        self.calls += 1
+        return getattr(obj, attr)
+
+    def _call(self, obj, method, *args):
+        self.calls += 1
+        return getattr(obj, method)(*args)
+
+    def _metadata(self, track_id, track):
+        meta = self.metadata.get(track_id)
+        if meta is None:
+            _time = self._read(track, 'time')
+            meta = (self._read(track, 'name'), self._read(track, 'artist'), self._read(track, 'album'),
+                    _time, get_sec('0:' + _time) if _time else 0)
+            self.metadata.put(track_id, meta)
+        return meta
+
+    def snapshot(self):
+        self.calls = 0
+        try:
+            track = self._read(self._app, 'currentTrack')
+            if track is None:
+                return None
+            track_id = (self._call(self._app, 'ITObjectPersistentIDHigh', track),
+                        self._call(self._app, 'ITObjectPersistentIDLow', track))
+            name, artist, album, _time, duration = self._metadata(track_id, track)
+            return TrackSnapshot(
+                track_id=track_id, name=name, artist=artist, album=album,
+                time=_time, duration=duration,
+                state=self._read(self._app, 'playerState'),
+                position=int(self._read(self._app, 'playerPosition')),
+                taken_at=self._clock())
+        finally:
+            self.last_calls = self.calls
+            self.total_calls += self.calls
+
+
+_fake_ids = itertools.count(1)
+
+
+class FakeTrack:
+    def __init__(self, name: str, artist: str, album: str, duration: int):
+        self.persistent_id = next(_fake_ids)
+        self.name = name
+        self.artist = artist
+        self.album = album
+        self.time = '{0}:{1:02d}'.format(duration // 60, duration % 60)
+
+
+class FakeApplication:
+    """In-process stand-in for ``iTunes.Application`` used by tests and benchmarks."""
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self.currentTrack = None
+        self.playerState = 0
+        self._position = 0.0
+        self._started = None
+
+    def ITObjectPersistentIDHigh(self, track: FakeTrack):
+        return track.persistent_id >> 32
+
+    def ITObjectPersistentIDLow(self, track: FakeTrack):
+        return track.persistent_id & 0xFFFFFFFF
+
+    @property
+    def playerPosition(self):
+        if self._started is None:
+            return int(self._position)
+        return int(self._position + self._clock() - self._started)
+
+    def play(self, track: FakeTrack = None, position: int = 0):
+        if track is not None:
+            self.currentTrack = track
+            self._position = float(position)
+        self._started = self._clock()
+        self.playerState = 1
+
+    def pause(self):
+        self._position = float(self.playerPosition)
+        self._started = None
+        self.playerState = 0
+
+    def stop(self):
+        self.currentTrack = None
+        self._position = 0.0
+        self._started = None
+        self.playerState = 0
@@ -1,9 +1,12 @@
+import asyncio
 import json
 import os
 import time
 
-from baseclient import BaseClient
-from payloads import Payload
+import ipc
+from baseclient import CONNECTION_ERRORS, BaseClient, backoff_delays
+from exceptions import InvalidPipe, ResponseTimeout, ServerError
+from payloads import Activity, ActivityValidator, Payload
 from utils import remove_none
 
 class Presence(BaseClient):
@@ -18,32 +21,227 @@ class Presence(BaseClient):
                      party_id: str = None, party_size: list = None,
                      join: str = None, spectate: str = None,
                      match: str = None, buttons: list = None,
-                     instance: bool = True,
-                     _donotuse=True):
+                     instance: bool = True, activity: Activity = None,
+                     timeout: float = None, wait: bool = True, _donotuse=True):
 
-        if _donotuse is True:
+        if activity is None and self.validator is not None:
+            activity = Activity(state, details, start, end, large_image, large_text, small_image, small_text,
+                                party_id, party_size, join, spectate, match, buttons, instance)
+        if _donotuse is True and activity is not None:
+            payload = self._activity_payload(activity, pid)
+        elif _donotuse is True:
             payload = Payload.set_activity(pid=pid, state=state, details=details, start=start, end=end, large_image=large_image, large_text=large_text,
                                        small_image=small_image, small_text=small_text, party_id=party_id, party_size=party_size, join=join, spectate=spectate,
                                        match=match, buttons=buttons, instance=instance, activity=True)
 
         else:
             payload = _donotuse
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, ack=self.fast_acks, timeout=timeout), wait)
 
-    def clear(self, pid: int = os.getpid()):
+    def clear(self, pid: int = os.getpid(), timeout: float = None, wait: bool = True):
         payload = Payload.set_activity(pid, activity=None)
-        self.send_data(1, payload)
-        return self.loop.run_until_complete(self.read_output())
+        return self._run(self.request(payload, ack=self.fast_acks, timeout=timeout), wait)
 
-    def connect(self):
-        self.update_event_loop(self.get_event_loop())
-        self.loop.run_until_complete(self.handshake())
+    def connect(self, wait: bool = True):
+        return self._run(self.handshake(), wait)
+
+    def reconnect(self, wait: bool = True):
+        return self._run(self._reconnect(), wait)
+
+    def ping(self, timeout: float = 5.0, wait: bool = True):
+        return self._run(self._ping(timeout), wait)
+
+    def keepalive(self, interval: float = 30.0, timeout: float = 5.0, wait: bool = True):
+        return self._run(self._keepalive(interval, timeout), wait)
 
     def close(self):
-        self.send_data(2, {'v': 1, 'client_id': self.client_id})
-        self.sock_writer.close()
-        self.loop.close()
+        self._stop_loop()
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class ChangeFilter:
+    """Skips presence updates that would render the same activity as the last one sent.
+
+    In front of a Coalescer, an update only counts as sent once the coalescer has
+    actually let it out; until then it is ``queued``, and a failed send is retried.
+    """
+
+    def __init__(self, presence: BaseClient = None):
+        self.presence = presence
+        self.last = None
+        self.queued = None
+        self.stats = {'sent': 0, 'suppressed': 0}
+
+    @staticmethod
+    def canonical(**kwargs):
+        if len(kwargs) == 1 and 'activity' in kwargs:
+            # An Activity is already hashable and compares by value.
+            return kwargs['activity']
+        return tuple(sorted((k, _freeze(v)) for k, v in kwargs.items() if v is not None))
+
+    def is_new(self, key) -> bool:
+        if key == (self.last if self.queued is None else self.queued):
+            self.stats['suppressed'] += 1
+            return False
+        return True
+
+    def record(self, key):
+        self.last = key
+        self.stats['sent'] += 1
+
+    def reset(self):
+        self.last = None
+        self.queued = None
+
+    def _settle(self, key):
+        if getattr(self.presence, 'pending', None) is not None:
+            self.queued = key
+        else:
+            self.record(key)
+
+    def update(self, **kwargs):
+        key = self.canonical(**kwargs)
+        if not self.is_new(key):
+            return None
+        self.queued = None
+        result = self.presence.update(**kwargs)
+        self._settle(key)
+        return result
+
+    def flush(self):
+        """Flush the coalescer behind this filter, recording the update once it is sent."""
+        key, self.queued = self.queued, None
+        result = self.presence.flush()
+        if key is not None:
+            self._settle(key)
+        return result
+
+
+class TokenBucket:
+    """Discord accepts roughly ``capacity`` activity updates per ``period`` seconds."""
+
+    def __init__(self, capacity: int = 5, period: float = 20.0, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self._clock = clock
+        self._tokens = float(capacity)
+        self._stamp = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def wait_time(self) -> float:
+        self._refill()
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def take(self) -> bool:
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class Coalescer:
+    """Holds back activity updates while the rate limit is spent, keeping only the newest one.
+
+    A pending update is released once no newer one has arrived for ``debounce``
+    seconds (or it has been held for ``max_hold``) and the bucket has a token,
+    so the last state of a burst always lands.
+    """
+
+    def __init__(self, presence: BaseClient = None, capacity: int = 5, period: float = 20.0,
+                 debounce: float = 0.25, max_hold: float = 2.0, clock=time.monotonic):
+        self.presence = presence
+        self.bucket = TokenBucket(capacity, period, clock)
+        self.debounce = debounce
+        self.max_hold = max_hold
+        self._clock = clock
+        self.pending = None
+        self._offered_at = 0.0
+        self._first_offered_at = 0.0
+        self._merged = 0
+        self.stats = {'offered': 0, 'sent': 0, 'dropped': 0, 'coalesced': 0}
+
+    @property
+    def depth(self) -> int:
+        return 0 if self.pending is None else 1
+
+    def offer(self, activity: dict):
+        self.stats['offered'] += 1
+        now = self._clock()
+        if self.pending is None:
+            self._first_offered_at = now
+        elif activity != self.pending:
+            self.stats['dropped'] += 1
+            self._merged += 1
+        self.pending = activity
+        self._offered_at = now
+
+    def deadline(self):
+        """Seconds until the pending update may go out, or None if nothing is pending."""
+        if self.pending is None:
+            return None
+        settle = min(self._offered_at + self.debounce, self._first_offered_at + self.max_hold) - self._clock()
+        return max(settle, self.bucket.wait_time(), 0.0)
+
+    def discard(self):
+        self.pending = None
+        self._merged = 0
+
+    def take(self):
+        if self.deadline() != 0.0 or not self.bucket.take():
+            return None
+        activity = self.pending
+        if self._merged:
+            self.stats['coalesced'] += 1
+        self.discard()
+        self.stats['sent'] += 1
+        return activity
+
+    def flush(self):
+        activity = self.take()
+        if activity is not None:
+            return self.presence.update(**activity)
+
+    def update(self, **kwargs):
+        self.offer(kwargs)
+        return self.flush()
+
+
+class AioCoalescer(Coalescer):
+    """Coalescer for AioPresence. ``update`` only queues; ``run`` sends from a task."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wakeup = asyncio.Event()
+
+    async def update(self, **kwargs):
+        self.offer(kwargs)
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            delay = self.deadline()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            activity = self.take()
+            if activity is not None:
+                await self.presence.update(**activity)
 
 
 class AioPresence(BaseClient):
@@ -59,24 +257,277 @@ class AioPresence(BaseClient):
                      party_id: str = None, party_size: list = None,
                      join: str = None, spectate: str = None,
                      match: str = None, buttons: list = None,
-                     instance: bool = True):
+                     instance: bool = True, activity: Activity = None,
+                     timeout: float = None):
 
-        payload = Payload.set_activity(pid=pid, state=state, details=details, start=start, end=end, large_image=large_image, large_text=large_text,
-                                    small_image=small_image, small_text=small_text, party_id=party_id, party_size=party_size, join=join, spectate=spectate,
-                                    match=match, buttons=buttons, instance=instance, activity=True)
-        self.send_data(1, payload)
-        return await self.read_output()
+        if activity is None and self.validator is not None:
+            activity = Activity(state, details, start, end, large_image, large_text, small_image, small_text,
+                                party_id, party_size, join, spectate, match, buttons, instance)
+        if activity is not None:
+            payload = self._activity_payload(activity, pid)
+        else:
+            payload = Payload.set_activity(pid=pid, state=state, details=details, start=start, end=end, large_image=large_image, large_text=large_text,
+                                        small_image=small_image, small_text=small_text, party_id=party_id, party_size=party_size, join=join, spectate=spectate,
+                                        match=match, buttons=buttons, instance=instance, activity=True)
+        return await self.request(payload, ack=self.fast_acks, timeout=timeout)
 
-    async def clear(self, pid: int = os.getpid()):
+    async def clear(self, pid: int = os.getpid(), timeout: float = None):
         payload = Payload.set_activity(pid, activity=None)
-        self.send_data(1, payload)
-        return await self.read_output()
+        return await self.request(payload, ack=self.fast_acks, timeout=timeout)
 
     async def connect(self):
         self.update_event_loop(self.get_event_loop())
         await self.handshake()
 
+    async def reconnect(self):
+        return await self._reconnect()
+
+    async def ping(self, timeout: float = 5.0):
+        return await self._ping(timeout)
+
+    async def keepalive(self, interval: float = 30.0, timeout: float = 5.0):
+        return await self._keepalive(interval, timeout)
+
     def close(self):
         self.send_data(2, {'v': 1, 'client_id': self.client_id})
         self.sock_writer.close()
         self.loop.close()
+
+
+class ConnectionStats:
+    __slots__ = ('sent', 'failed', 'timeouts', 'latency', 'last_error', 'healthy')
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.latency = None
+        self.last_error = None
+        self.healthy = True
+
+    def record(self, latency: float):
+        self.sent += 1
+        self.healthy = True
+        # Exponentially weighted, so one slow reply doesn't dominate.
+        self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+
+    def __repr__(self):
+        return '<ConnectionStats sent={0} failed={1} timeouts={2} latency={3} healthy={4}>'.format(
+            self.sent, self.failed, self.timeouts, self.latency, self.healthy)
+
+
+class MultiPresence:
+    """Sends the same activity to every Discord client running (stable, PTB, Canary...).
+
+    Holds one AioPresence per IPC endpoint. Updates go to all of them concurrently,
+    encoded once, each as its own task with ``timeout`` seconds, and an update returns
+    once any connection has accepted it, so a slow or dead client can't hold up the
+    others.
+
+    Once ``keepalive`` runs, every connection has its own supervisor that pings it and
+    reconnects it when it dies; after ``max_failures`` reconnects in a row fail, the
+    endpoint is dropped. Endpoints are looked for again every ``probe_interval``
+    seconds, so a client started later (or one that came back) is picked up.
+    """
+
+    def __init__(self, client_id: str, paths: list = None, timeout: float = 5.0, max_failures: int = 3,
+                 probe_interval: float = 60.0, **kwargs):
+        self.client_id = client_id
+        self.paths = paths
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.probe_interval = probe_interval
+        # Connections are supervised here; a client retrying on its own would never give up.
+        kwargs['reconnect'] = False
+        self.kwargs = kwargs
+        validate = kwargs.get('validate', None)
+        self.validator = ActivityValidator(validate) if validate else None
+        self.clients = {}
+        self.stats = {}
+        self._sends = {}
+        self._supervisors = {}
+        self._lost = {}
+        self._probed = 0.0
+        self._last_activity = None
+
+    def _backoff(self):
+        return backoff_delays(self.kwargs.get('backoff_base', 1.0), self.kwargs.get('backoff_max', 60.0))
+
+    async def _probe(self) -> list:
+        """Connect to every endpoint that isn't connected yet. Returns the new ones."""
+        self._probed = time.monotonic()
+        paths = [path for path in (self.paths or ipc.candidate_paths()) if path not in self.clients]
+        clients = {path: AioPresence(self.client_id, ipc_path=path, **self.kwargs) for path in paths}
+        results = await asyncio.gather(*(asyncio.wait_for(client.connect(), self.timeout)
+                                         for client in clients.values()), return_exceptions=True)
+        found = []
+        for (path, client), result in zip(clients.items(), results):
+            if isinstance(result, BaseException):
+                client._close_pipe()
+                continue
+            self.clients[path] = client
+            self.stats.setdefault(path, ConnectionStats())
+            found.append(path)
+        return found
+
+    async def connect(self):
+        await self._probe()
+        if not self.clients:
+            raise InvalidPipe
+
+    async def reconnect(self):
+        for delay in self._backoff():
+            self._close_pipe()
+            try:
+                await self.connect()
+            except InvalidPipe:
+                await asyncio.sleep(delay)
+            else:
+                break
+        if self._last_activity is not None:
+            return await self._broadcast(self._last_activity)
+
+    async def _send(self, path: str, client: AioPresence, payload: Payload):
+        stats = self.stats[path]
+        sent = time.monotonic()
+        try:
+            # Connections don't reconnect on their own here, so the request timeout bounds the whole send.
+            reply = await client.request(payload, ack=client.fast_acks, timeout=self.timeout)
+        except ResponseTimeout:
+            stats.timeouts += 1
+            stats.healthy = False
+            raise
+        except Exception as e:
+            stats.failed += 1
+            stats.last_error = e
+            stats.healthy = not isinstance(e, CONNECTION_ERRORS)
+            raise
+        stats.record(time.monotonic() - sent)
+        return reply
+
+    def _dispatch(self, path: str, payload: Payload) -> asyncio.Task:
+        """Send ``payload`` to one connection as its own task, superseding any send still in flight there."""
+        previous = self._sends.get(path)
+        if previous is not None and not previous.done():
+            # The cancelled request expires its nonce, so its reply is dropped when it lands.
+            previous.cancel()
+        task = asyncio.ensure_future(self._send(path, self.clients[path], payload))
+        self._sends[path] = task
+        task.add_done_callback(lambda task: self._sent(path, task))
+        return task
+
+    def _sent(self, path: str, task: asyncio.Task):
+        if self._sends.get(path) is task:
+            del self._sends[path]
+        # _send has already recorded any failure in ConnectionStats.
+        if not task.cancelled() and isinstance(task.exception(), CONNECTION_ERRORS) and path in self._lost:
+            self._lost[path].set()
+
+    async def _broadcast(self, payload: Payload) -> dict:
+        """Sends to every connection at once and returns as soon as one of them has accepted.
+
+        Slower connections finish in the background. Returns the replies (or exceptions)
+        in by then, and raises only if every connection failed.
+        """
+        tasks = {path: self._dispatch(path, payload) for path in list(self.clients)}
+        pending = set(tasks.values())
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if any(not task.cancelled() and task.exception() is None for task in done):
+                break
+        replies = {path: task.exception() or task.result() for path, task in tasks.items()
+                   if task.done() and not task.cancelled()}
+        errors = [result for result in replies.values() if isinstance(result, BaseException)]
+        if not pending and len(errors) == len(tasks):
+            for error in errors:
+                if isinstance(error, ServerError):
+                    raise error
+            raise ConnectionResetError('No Discord client is reachable')
+        return replies
+
+    async def update(self, activity: Activity = None, **kwargs):
+        pid = kwargs.pop('pid', os.getpid())
+        if activity is None and self.validator is not None:
+            activity = Activity(**kwargs)
+        if activity is not None:
+            if self.validator is not None:
+                activity = self.validator(activity)
+            payload = Payload.from_activity(activity, pid)
+        else:
+            payload = Payload.set_activity(pid, activity=True, **kwargs)
+        self._last_activity = payload
+        return await self._broadcast(payload)
+
+    async def clear(self, pid: int = os.getpid()):
+        payload = Payload.set_activity(pid, activity=None)
+        self._last_activity = payload
+        return await self._broadcast(payload)
+
+    async def keepalive(self, interval: float = 30.0, timeout: float = 5.0):
+        """Starts a supervisor for each new connection and probes for new endpoints when due.
+
+        Never waits on any one connection. Raises once every endpoint has been dropped.
+        """
+        if time.monotonic() - self._probed >= self.probe_interval:
+            for path in await self._probe():
+                if self._last_activity is not None:
+                    self._dispatch(path, self._last_activity)
+        for path in self.clients:
+            if path not in self._supervisors:
+                self._lost[path] = asyncio.Event()
+                task = self._supervisors[path] = asyncio.ensure_future(self._supervise(path, interval, timeout))
+                task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        if not self.clients:
+            raise ConnectionResetError('No Discord client is reachable')
+
+    async def _supervise(self, path: str, interval: float, timeout: float):
+        client = self.clients[path]
+        lost = self._lost[path]
+        while True:
+            try:
+                # A send failing with a connection error wakes us up early.
+                await asyncio.wait_for(lost.wait(), interval)
+            except asyncio.TimeoutError:
+                try:
+                    await client.keepalive(interval, timeout)
+                    continue
+                except CONNECTION_ERRORS:
+                    pass
+            self.stats[path].healthy = False
+            failures = 0
+            for delay in self._backoff():
+                client._close_pipe()
+                try:
+                    await asyncio.wait_for(client.handshake(), self.timeout)
+                except CONNECTION_ERRORS + (asyncio.TimeoutError,):
+                    failures += 1
+                    if failures >= self.max_failures:
+                        self._drop(path)
+                        return
+                    await asyncio.sleep(delay)
+                else:
+                    break
+            # Sends failed by closing the old pipe above have set it again by now.
+            lost.clear()
+            self.stats[path].healthy = True
+            if self._last_activity is not None:
+                self._dispatch(path, self._last_activity)
+
+    def _drop(self, path: str):
+        """Forget an endpoint that stayed dead; the next probe picks it up again if it returns."""
+        client = self.clients.pop(path)
+        client._close_pipe()
+        send = self._sends.pop(path, None)
+        if send is not None:
+            send.cancel()
+        self._supervisors.pop(path, None)
+        self._lost.pop(path, None)
+
+    def _close_pipe(self):
+        for task in list(self._sends.values()) + list(self._supervisors.values()):
+            task.cancel()
+        for client in self.clients.values():
+            client._close_pipe()
+        self.clients = {}
+        self._supervisors = {}
+        self._lost = {}
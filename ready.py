@@ -0,0 +1,53 @@
+"""The READY payload Discord answers the handshake with, kept on the client as ``client.ready``."""
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+
+
+def _frozen(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _frozen(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_frozen(v) for v in value)
+    return value
+
+
+class User(NamedTuple):
+    id: str
+    username: str
+    discriminator: str
+    avatar: Optional[str]
+    bot: bool
+    flags: int
+    premium_type: int
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """None when READY carried no user."""
+        if not data:
+            return None
+        return cls(str(data.get('id')), data.get('username'), data.get('discriminator'), data.get('avatar'),
+                   data.get('bot', False), data.get('flags', 0), data.get('premium_type', 0))
+
+
+class Config(NamedTuple):
+    cdn_host: str
+    api_endpoint: str
+    environment: str
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data.get('cdn_host'), data.get('api_endpoint'), data.get('environment'))
+
+
+class Ready(NamedTuple):
+    version: int
+    user: Optional[User]
+    config: Config
+    # The whole READY data, read-only, for fields not mapped above.
+    data: MappingProxyType
+
+    @classmethod
+    def from_payload(cls, payload: dict):
+        data = payload.get('data') or {}
+        return cls(data.get('v'), User.from_dict(data.get('user')),
+                   Config.from_dict(data.get('config') or {}), _frozen(data))
@@ -0,0 +1,63 @@
+"""Deadline-driven poll scheduling for the iTunes loop."""
+import threading
+import time
+
+from player import TrackSnapshot
+
+
+class Scheduler:
+    """Works out when the next poll is worth doing.
+
+    While a track plays, the next deadline is the end of the track plus a short
+    guard, capped at ``max_interval`` so skips and pauses are still noticed as soon
+    as the old fixed 15s poll noticed them. Paused and stopped players back off from
+    ``min_idle`` to ``max_idle``; that is where the polls are saved, and the price is
+    that a resume can take up to ``max_idle`` to show. ``wait`` can be cut short from
+    any thread with ``wake`` or ``stop``.
+    """
+
+    def __init__(self, guard: float = 0.75, min_interval: float = 0.5,
+                 max_interval: float = 15.0, min_idle: float = 5.0, max_idle: float = 60.0):
+        self.guard = guard
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.polls = 0
+        self._idle = min_idle
+        self._event = threading.Event()
+        self._stopped = False
+
+    @property
+    def running(self):
+        return not self._stopped
+
+    def next_delay(self, track: TrackSnapshot = None, now: float = None) -> float:
+        self.polls += 1
+        if track is None or track.paused:
+            delay = self._idle
+            self._idle = min(self._idle * 2, self.max_idle)
+            return delay
+
+        self._idle = self.min_idle
+        if now is None:
+            now = time.time()
+        remaining = track.duration - track.position
+        if remaining <= 0:
+            return self.min_interval
+        deadline = track.taken_at + remaining + self.guard
+        return max(self.min_interval, min(deadline - now, self.max_interval))
+
+    def wait(self, delay: float) -> bool:
+        """Sleep for ``delay`` seconds or until woken. Returns False once stopped."""
+        if not self._stopped:
+            self._event.wait(delay)
+            self._event.clear()
+        return not self._stopped
+
+    def wake(self):
+        self._event.set()
+
+    def stop(self):
+        self._stopped = True
+        self._event.set()
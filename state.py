@@ -0,0 +1,47 @@
+"""Small crash-safe state files kept next to the script."""
+import json
+import os
+import tempfile
+
+
+def atomic_write(path: str, data: str):
+    """Replace ``path`` with ``data`` so readers only ever see the old or the new contents."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class StateJournal:
+    """A JSON document held in memory and only rewritten when a value changes."""
+
+    def __init__(self, path: str = '.state'):
+        self.path = path
+        self._data = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def get(self, key: str, default=None):
+        return self._data.get(key, default)
+
+    def update(self, **values):
+        if all(self._data.get(k) == v for k, v in values.items()):
+            return
+        self._data.update(values)
+        atomic_write(self.path, json.dumps(self._data))
@@ -0,0 +1,79 @@
+"""An in-process stand-in for Discord's IPC endpoint, on a unix socket."""
+import asyncio
+import json
+import struct
+
+READY = {'v': 1, 'config': {'cdn_host': 'cdn.discordapp.com', 'api_endpoint': '//discord.com/api',
+                            'environment': 'production'},
+         'user': {'id': '1', 'username': 'user', 'discriminator': '0', 'avatar': None}}
+
+
+def frame(op: int, obj) -> bytes:
+    body = json.dumps(obj).encode()
+    return struct.pack('<II', op, len(body)) + body
+
+
+class ServerError(Exception):
+    """Raised by a handler to answer with an ERROR frame."""
+
+
+class FakeDiscord:
+    """Answers every command concurrently, so replies can come back out of order.
+
+    ``handlers`` maps a command to a coroutine function taking the request body and
+    returning the reply's ``data``. Commands without a handler echo their args.
+    With ``silent`` set, handshakes are accepted but never answered with READY.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.handlers = {}
+        self.received = []
+        self.silent = False
+        self._writers = []
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(self._serve, self.path)
+        return self
+
+    async def close(self):
+        for writer in self._writers:
+            writer.close()
+        self._server.close()
+        await self._server.wait_closed()
+
+    def dispatch(self, evt: str, data: dict = None):
+        for writer in self._writers:
+            writer.write(frame(1, {'cmd': 'DISPATCH', 'evt': evt, 'data': data or {}, 'nonce': None}))
+
+    async def _serve(self, reader, writer):
+        self._writers.append(writer)
+        try:
+            while True:
+                op, length = struct.unpack('<II', await reader.readexactly(8))
+                body = json.loads(await reader.readexactly(length))
+                if op == 0 and not self.silent:
+                    writer.write(frame(1, {'cmd': 'DISPATCH', 'evt': 'READY', 'data': READY, 'nonce': None}))
+                elif op == 1:
+                    self.received.append(body)
+                    asyncio.ensure_future(self._reply(body, writer))
+                elif op == 3:
+                    writer.write(frame(4, body))
+                elif op == 2:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.remove(writer)
+            writer.close()
+
+    async def _reply(self, body: dict, writer):
+        cmd = body.get('cmd')
+        handler = self.handlers.get(cmd)
+        try:
+            data, evt = (await handler(body) if handler else body.get('args')), None
+        except ServerError as e:
+            data, evt = {'code': 4000, 'message': str(e)}, 'ERROR'
+        if not writer.is_closing():
+            writer.write(frame(1, {'cmd': cmd, 'data': data, 'evt': evt, 'nonce': body.get('nonce')}))
@@ -0,0 +1,110 @@
+import pytest
+
+from presence import ChangeFilter, Coalescer, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakePresence:
+    def __init__(self):
+        self.sent = []
+        self.fail = None
+
+    def update(self, **kwargs):
+        if self.fail is not None:
+            raise self.fail
+        self.sent.append(kwargs)
+
+
+def test_bucket_refills_at_its_rate():
+    clock = Clock()
+    bucket = TokenBucket(capacity=5, period=20.0, clock=clock)
+    assert all(bucket.take() for _ in range(5))
+    assert not bucket.take()
+    assert bucket.wait_time() == pytest.approx(4.0)
+    clock.now = 4.0
+    assert bucket.take()
+    assert not bucket.take()
+
+
+def test_burst_collapses_to_the_newest_activity():
+    clock = Clock()
+    presence = FakePresence()
+    coalescer = Coalescer(presence, debounce=0.25, clock=clock)
+    for i in range(10):
+        coalescer.update(details=str(i))
+        clock.now += 0.01
+    assert presence.sent == []
+    assert coalescer.depth == 1
+    clock.now += 0.25
+    coalescer.flush()
+    assert presence.sent == [{'details': '9'}]
+    assert coalescer.stats == {'offered': 10, 'sent': 1, 'dropped': 9, 'coalesced': 1}
+    assert coalescer.deadline() is None
+
+
+def test_max_hold_releases_a_steady_stream():
+    clock = Clock()
+    presence = FakePresence()
+    coalescer = Coalescer(presence, debounce=0.25, max_hold=1.0, clock=clock)
+    for i in range(20):
+        coalescer.update(details=str(i))
+        clock.now += 0.1
+    # Never quiet for the debounce, but nothing is held longer than max_hold.
+    assert len(presence.sent) >= 1
+    assert presence.sent[0] != {'details': '0'}
+
+
+def test_held_update_waits_for_a_token():
+    clock = Clock()
+    presence = FakePresence()
+    coalescer = Coalescer(presence, capacity=1, period=10.0, debounce=0.0, clock=clock)
+    coalescer.update(details='a')
+    coalescer.update(details='b')
+    assert presence.sent == [{'details': 'a'}]
+    assert coalescer.deadline() == pytest.approx(10.0)
+    clock.now = 10.0
+    coalescer.flush()
+    assert presence.sent == [{'details': 'a'}, {'details': 'b'}]
+
+
+def test_filter_records_a_queued_update_only_once_it_is_sent():
+    clock = Clock()
+    presence = FakePresence()
+    coalescer = Coalescer(presence, debounce=0.25, clock=clock)
+    activity = ChangeFilter(coalescer)
+    activity.update(details='a')
+    assert activity.last is None and activity.queued is not None
+    # The same activity while it is still queued is not offered twice.
+    activity.update(details='a')
+    assert coalescer.stats['offered'] == 1
+    clock.now = 1.0
+    activity.flush()
+    assert presence.sent == [{'details': 'a'}]
+    assert activity.last == ChangeFilter.canonical(details='a') and activity.queued is None
+    activity.update(details='a')
+    assert activity.stats == {'sent': 1, 'suppressed': 2}
+
+
+def test_failed_flush_is_retried_on_the_next_update():
+    clock = Clock()
+    presence = FakePresence()
+    coalescer = Coalescer(presence, debounce=0.25, clock=clock)
+    activity = ChangeFilter(coalescer)
+    activity.update(details='a')
+    clock.now = 1.0
+    presence.fail = ConnectionResetError()
+    with pytest.raises(ConnectionResetError):
+        activity.flush()
+    assert activity.last is None and activity.queued is None
+    presence.fail = None
+    activity.update(details='a')
+    clock.now = 2.0
+    activity.flush()
+    assert presence.sent == [{'details': 'a'}]
@@ -0,0 +1,23 @@
+from codec import get_codec, is_error, peek_nonce
+
+
+def test_fast_path_reads_top_level_keys():
+    body = get_codec('json').dumps({'cmd': 'SET_ACTIVITY', 'data': {}, 'evt': None, 'nonce': '42'})
+    assert peek_nonce(memoryview(body)) == '42'
+    assert not is_error(memoryview(body))
+
+
+def test_error_frame_is_recognised():
+    body = b'{"cmd": "SET_ACTIVITY", "data": {"code": 4000}, "evt": "ERROR", "nonce": "42"}'
+    assert is_error(body)
+
+
+def test_keys_nested_in_data_defer_to_a_full_decode():
+    body = b'{"cmd": "X", "data": {"nonce": "inner", "evt": "ERROR"}, "evt": null, "nonce": "outer"}'
+    assert peek_nonce(body) is None
+    assert is_error(body)
+
+
+def test_missing_or_null_nonce():
+    assert peek_nonce(b'{"cmd": "DISPATCH", "evt": "READY", "nonce": null}') is None
+    assert peek_nonce(b'{"cmd": "DISPATCH"}') is None
@@ -0,0 +1,62 @@
+import asyncio
+import sys
+
+import pytest
+
+import fakediscord
+from daemon import Daemon
+from presence import Coalescer
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='the fake endpoint is a unix socket')
+
+
+class Player:
+    def __init__(self, track):
+        self.track = track
+
+    def snapshot(self):
+        return self.track
+
+
+class Details:
+    def render(self, track):
+        return dict(details=track)
+
+
+class Every:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def next_delay(self, track):
+        return self.delay
+
+
+async def received(server, details, timeout=5.0):
+    async def poll():
+        while not any(body['args']['activity'].get('details') == details
+                      for body in server.received if body['cmd'] == 'SET_ACTIVITY'):
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_activity_lost_with_the_pipe_is_sent_after_reconnect(tmp_path):
+    async def main():
+        path = str(tmp_path / 'discord-ipc-0')
+        server = await fakediscord.FakeDiscord(path).start()
+        player = Player('A')
+        daemon = Daemon('1', lambda: player, Details(), scheduler=Every(0.05), ping_interval=0.1,
+                        ipc_path=path, timeout=0.5)
+        daemon.coalescer = Coalescer(debounce=0.01)
+        task = asyncio.ensure_future(daemon.run())
+        try:
+            await received(server, 'A')
+            await server.close()
+            server = await fakediscord.FakeDiscord(path).start()
+            player.track = 'B'
+            await received(server, 'B')
+            assert daemon.filter.last == (('details', 'B'),)
+        finally:
+            daemon.stop()
+            await task
+            await server.close()
+    asyncio.run(main())
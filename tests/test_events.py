@@ -0,0 +1,141 @@
+import asyncio
+import sys
+
+import pytest
+
+import fakediscord
+from client import AioClient
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='the fake endpoint is a unix socket')
+
+
+def run(tmp_path, test, **kwargs):
+    async def main():
+        server = await fakediscord.FakeDiscord(str(tmp_path / 'discord-ipc-0')).start()
+        client = AioClient('1', ipc_path=server.path, **kwargs)
+        await client.start()
+        try:
+            await test(server, client)
+        finally:
+            client._close_pipe()
+            client.events.stop()
+            await server.close()
+    asyncio.run(main())
+
+
+async def until(condition, timeout=2.0):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.005)
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_no_more_than_workers_handlers_run_at_once(tmp_path):
+    async def test(server, client):
+        running, peak, handled = [0], [0], []
+
+        async def handler(data):
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            await asyncio.sleep(0.02)
+            running[0] -= 1
+            handled.append(data['n'])
+
+        await client.register_event('MESSAGE_CREATE', handler)
+        for n in range(8):
+            server.dispatch('MESSAGE_CREATE', {'n': n})
+        await until(lambda: len(handled) == 8)
+        assert peak[0] == 2
+        assert client.events.stats['MESSAGE_CREATE'].handled == 8
+
+    run(tmp_path, test, event_workers=2)
+
+
+def test_ordered_handles_each_type_in_arrival_order(tmp_path):
+    async def test(server, client):
+        handled = []
+
+        async def slower_first(data):
+            await asyncio.sleep(0.02 * (3 - data['n']))
+            handled.append(('a', data['n']))
+
+        async def quick(data):
+            handled.append(('b', data['n']))
+
+        await client.register_event('MESSAGE_CREATE', slower_first)
+        await client.register_event('MESSAGE_UPDATE', quick)
+        for n in range(3):
+            server.dispatch('MESSAGE_CREATE', {'n': n})
+        server.dispatch('MESSAGE_UPDATE', {'n': 0})
+        await until(lambda: len(handled) == 4)
+        assert [n for kind, n in handled if kind == 'a'] == [0, 1, 2]
+        # With a worker to spare, another type isn't held up behind the ordered chain.
+        assert handled[0] == ('b', 0)
+
+    run(tmp_path, test, event_ordered=True, event_workers=4)
+
+
+def blocked_handler(handled, release):
+    async def handler(data):
+        if data['n'] == 0:
+            await release.wait()
+        handled.append(data['n'])
+    return handler
+
+
+@pytest.mark.parametrize('overflow, expected, dropped', [
+    # The first event is being handled; two more fit in the queue.
+    ('drop_oldest', [0, 4, 5], 3),
+    ('shed', [0, 1, 2], 3),
+    ('block', [0, 1, 2, 3, 4, 5], 0),
+])
+def test_overflow_policies(tmp_path, overflow, expected, dropped):
+    async def test(server, client):
+        handled, release = [], asyncio.Event()
+        await client.register_event('MESSAGE_CREATE', blocked_handler(handled, release))
+        server.dispatch('MESSAGE_CREATE', {'n': 0})
+        await until(lambda: client.events.stats.get('MESSAGE_CREATE') and client.events.queue.empty())
+        for n in range(1, 6):
+            server.dispatch('MESSAGE_CREATE', {'n': n})
+        await until(lambda: client.events.stats['MESSAGE_CREATE'].received == 6)
+        if overflow == 'block':
+            assert not client.sock_writer.is_reading()
+            reply = asyncio.ensure_future(client.get_channel(1))
+            await asyncio.sleep(0.05)
+            # Replies queue behind the blocked events.
+            assert not reply.done()
+        release.set()
+        await until(lambda: len(handled) == len(expected))
+        assert handled == expected
+        assert client.events.stats['MESSAGE_CREATE'].dropped == dropped
+        if overflow == 'block':
+            assert (await reply)['data'] == {'channel_id': '1'}
+            assert client.sock_writer.is_reading()
+
+    run(tmp_path, test, event_queue_size=2, event_workers=1, event_overflow=overflow)
+
+
+def test_handler_errors_go_to_report_error(tmp_path):
+    errors = []
+
+    async def on_error(exc, future):
+        errors.append(exc)
+
+    async def test(server, client):
+        handled = []
+
+        async def handler(data):
+            if data['n'] == 1:
+                raise ValueError('bad event')
+            handled.append(data['n'])
+
+        await client.register_event('MESSAGE_CREATE', handler)
+        for n in range(3):
+            server.dispatch('MESSAGE_CREATE', {'n': n})
+        await until(lambda: len(handled) == 2 and errors)
+        assert [str(e) for e in errors] == ['bad event']
+        stats = client.events.stats['MESSAGE_CREATE']
+        assert (stats.handled, stats.failed) == (2, 1)
+        assert stats.latency.count == 3
+
+    run(tmp_path, test, handler=on_error)
@@ -0,0 +1,53 @@
+import struct
+
+from ipc import FrameDecoder
+
+
+def frame(op: int, body: bytes) -> bytes:
+    return struct.pack('<II', op, len(body)) + body
+
+
+def decoder():
+    frames = []
+    # The memoryview is only valid during the callback, so keep a copy.
+    return FrameDecoder(lambda op, body: frames.append((op, bytes(body)))), frames
+
+
+def test_whole_frames_in_one_chunk():
+    dec, frames = decoder()
+    dec.feed(frame(1, b'{"a":1}') + frame(3, b'{}') + frame(2, b''))
+    assert frames == [(1, b'{"a":1}'), (3, b'{}'), (2, b'')]
+
+
+def test_frames_split_at_every_byte():
+    data = frame(1, b'{"nonce":"1"}') + frame(1, b'{"nonce":"2"}')
+    for split in range(1, len(data)):
+        dec, frames = decoder()
+        dec.feed(data[:split])
+        dec.feed(data[split:])
+        assert frames == [(1, b'{"nonce":"1"}'), (1, b'{"nonce":"2"}')], split
+
+
+def test_one_byte_at_a_time():
+    data = frame(1, b'hello') + frame(4, b'world')
+    dec, frames = decoder()
+    for i in range(len(data)):
+        dec.feed(data[i:i + 1])
+    assert frames == [(1, b'hello'), (4, b'world')]
+
+
+def test_trailing_partial_frame_waits_for_the_rest():
+    dec, frames = decoder()
+    whole, partial = frame(1, b'first'), frame(1, b'second')
+    dec.feed(whole + partial[:5])
+    assert frames == [(1, b'first')]
+    dec.feed(partial[5:])
+    assert frames == [(1, b'first'), (1, b'second')]
+
+
+def test_reset_drops_a_buffered_partial_frame():
+    dec, frames = decoder()
+    dec.feed(frame(1, b'stale')[:6])
+    dec.reset()
+    dec.feed(frame(1, b'fresh'))
+    assert frames == [(1, b'fresh')]
@@ -0,0 +1,38 @@
+import asyncio
+import sys
+
+import pytest
+
+import fakediscord
+from presence import MultiPresence
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='the fake endpoint is a unix socket')
+
+
+@pytest.mark.parametrize('fast_acks', [False, True])
+def test_superseded_sends_leave_no_stray_frames(tmp_path, fast_acks):
+    async def main():
+        fast = await fakediscord.FakeDiscord(str(tmp_path / 'discord-ipc-0')).start()
+        slow = await fakediscord.FakeDiscord(str(tmp_path / 'discord-ipc-1')).start()
+
+        async def lagging(body):
+            await asyncio.sleep(0.1)
+            return body['args']
+
+        slow.handlers['SET_ACTIVITY'] = lagging
+        presence = MultiPresence('1', paths=[fast.path, slow.path], timeout=1.0, fast_acks=fast_acks)
+        await presence.connect()
+        try:
+            for i in range(5):
+                await presence.update(details='song {0}'.format(i))
+            # Every superseded send's reply has come back by now.
+            await asyncio.sleep(0.3)
+            assert len(slow.received) == 5
+            for client in presence.clients.values():
+                assert client._frames.empty()
+                assert not client._pending
+        finally:
+            presence._close_pipe()
+            await fast.close()
+            await slow.close()
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from codec import JSONCodec
+from payloads import Payload
+from utils import remove_none
+
+
+def baseline(nonce, pid, state=None, details=None, start=None, end=None, large_image=None, large_text=None,
+             small_image=None, small_text=None, party_id=None, party_size=None, join=None, spectate=None,
+             match=None, buttons=None, instance=True, activity=True):
+    """The SET_ACTIVITY dict as Payload.set_activity built it before the templates."""
+    if start:
+        start = int(start)
+    if end:
+        end = int(end)
+    if activity is None:
+        act_details = None
+    else:
+        act_details = {
+            "state": state,
+            "details": details,
+            "timestamps": {"start": start, "end": end},
+            "assets": {"large_image": large_image, "large_text": large_text,
+                       "small_image": small_image, "small_text": small_text},
+            "party": {"id": party_id, "size": party_size},
+            "secrets": {"join": join, "spectate": spectate, "match": match},
+            "buttons": buttons,
+            "instance": instance,
+        }
+    return {"cmd": "SET_ACTIVITY", "args": {"pid": pid, "activity": act_details}, "nonce": nonce}
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(activity=None),
+    dict(details='Some Song by Some Artist'),
+    dict(details='Song', state='from Album', large_image='icon', start=1700000000, end=1700000240),
+    dict(details='Sigur Rós – Hoppípolla', state='from Takk…', large_text='日本語のアルバム'),
+    dict(details='Quote "this" and \\ that', small_image='icon', small_text='\n\t'),
+    dict(details='Paused', start=0, end=0),
+    dict(details='Song', start=1700000000.9, instance=False),
+    dict(details='Song', buttons=[{'label': 'Listen', 'url': 'https://example.com/a?b=1&c=2'}]),
+    dict(party_id='party', party_size=[1, 4], join='j', spectate='s', match='m'),
+])
+def test_set_activity_encodes_to_the_same_bytes_as_before(kwargs):
+    payload = Payload.set_activity(4242, **kwargs)
+    expected = json.dumps(remove_none(baseline(payload.request_nonce, 4242, **kwargs))).encode('utf-8')
+    assert payload.encode(JSONCodec) == expected
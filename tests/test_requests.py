@@ -0,0 +1,188 @@
+import asyncio
+import sys
+
+import pytest
+
+import fakediscord
+from client import AioClient
+from codec import CODECS
+from exceptions import ResponseTimeout, ServerError
+from payloads import Payload
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='the fake endpoint is a unix socket')
+
+
+def run(tmp_path, test, **kwargs):
+    async def main():
+        server = await fakediscord.FakeDiscord(str(tmp_path / 'discord-ipc-0')).start()
+        client = AioClient('1', ipc_path=server.path, **kwargs)
+        await client.start()
+        try:
+            await test(server, client)
+        finally:
+            client._close_pipe()
+            await server.close()
+    asyncio.run(main())
+
+
+def test_replies_out_of_order_reach_their_own_request(tmp_path):
+    async def test(server, client):
+        async def slower_for_lower_ids(body):
+            await asyncio.sleep(0.01 * (5 - int(body['args']['channel_id'])))
+            return body['args']
+
+        server.handlers['GET_CHANNEL'] = slower_for_lower_ids
+        replies = await asyncio.gather(*(client.get_channel(i) for i in range(5)))
+        assert [reply['data']['channel_id'] for reply in replies] == ['0', '1', '2', '3', '4']
+        nonces = [body['nonce'] for body in server.received]
+        assert len(set(nonces)) == 5
+
+    run(tmp_path, test)
+
+
+def test_error_reply_fails_only_its_request(tmp_path):
+    async def test(server, client):
+        async def reject_odd(body):
+            if int(body['args']['guild_id']) % 2:
+                raise fakediscord.ServerError('no such guild')
+            return body['args']
+
+        server.handlers['GET_GUILD'] = reject_odd
+        results = await asyncio.gather(*(client.get_guild(i) for i in range(4)), return_exceptions=True)
+        assert results[0]['data'] == {'guild_id': '0'}
+        assert results[2]['data'] == {'guild_id': '2'}
+        assert isinstance(results[1], ServerError) and isinstance(results[3], ServerError)
+
+    run(tmp_path, test)
+
+
+def test_late_reply_after_timeout_is_dropped(tmp_path):
+    async def test(server, client):
+        async def slow(body):
+            await asyncio.sleep(0.2)
+            return {'late': True}
+
+        server.handlers['GET_GUILDS'] = slow
+        with pytest.raises(ResponseTimeout):
+            await client.get_guilds(timeout=0.05)
+        assert client.timeouts == 1
+        del server.handlers['GET_GUILDS']
+        await asyncio.sleep(0.3)
+        # The stale reply arrived in between and must not be taken for this one,
+        # nor left queued for the next read().
+        assert client._frames.empty()
+        with pytest.raises(ResponseTimeout):
+            await client.read_output(timeout=0.05)
+        reply = await client.get_channel(7)
+        assert reply['data'] == {'channel_id': '7'}
+        assert not client._pending
+
+    run(tmp_path, test)
+
+
+def test_late_reply_after_cancel_is_dropped(tmp_path):
+    async def test(server, client):
+        async def slow(body):
+            await asyncio.sleep(0.1)
+            return {'late': True}
+
+        server.handlers['GET_GUILDS'] = slow
+        request = asyncio.ensure_future(client.get_guilds())
+        await asyncio.sleep(0.02)
+        request.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await request
+        await asyncio.sleep(0.2)
+        assert client._frames.empty()
+        with pytest.raises(ResponseTimeout):
+            await client.read_output(timeout=0.05)
+        assert not client._pending
+
+    run(tmp_path, test)
+
+
+def test_handshake_without_ready_times_out(tmp_path):
+    async def main():
+        server = await fakediscord.FakeDiscord(str(tmp_path / 'discord-ipc-0')).start()
+        server.silent = True
+        client = AioClient('1', ipc_path=server.path, timeout=0.1)
+        try:
+            with pytest.raises(ConnectionResetError):
+                await asyncio.wait_for(client.start(), 2)
+        finally:
+            client._close_pipe()
+            await server.close()
+    asyncio.run(main())
+
+
+def test_reconnect_retries_a_handshake_without_ready(tmp_path):
+    async def test(server, client):
+        server.silent = True
+        for writer in list(server._writers):
+            writer.close()
+        await asyncio.sleep(0.05)
+        reply = asyncio.ensure_future(client.get_channel(1))
+        await asyncio.sleep(0.3)
+        assert not reply.done()
+        server.silent = False
+        assert (await asyncio.wait_for(reply, 2))['data'] == {'channel_id': '1'}
+        assert client.reconnects == 1
+
+    run(tmp_path, test, timeout=0.1, reconnect=True, backoff_base=0.05)
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_acknowledged_requests_return_none_and_still_raise(tmp_path, codec):
+    async def test(server, client):
+        assert await client.request(Payload.set_activity(1, details='ok'), ack=True) is None
+
+        async def reject(body):
+            raise fakediscord.ServerError('bad activity')
+
+        server.handlers['SET_ACTIVITY'] = reject
+        with pytest.raises(ServerError):
+            await client.request(Payload.set_activity(1, details='bad'), ack=True)
+        assert not client._pending and not client._acks and client._frames.empty()
+
+    run(tmp_path, test, codec=codec)
+
+
+def test_bulk_keeps_at_most_limit_in_flight_and_fetches_each_id_once(tmp_path):
+    async def test(server, client):
+        outstanding, peak = [0], [0]
+
+        async def counted(body):
+            outstanding[0] += 1
+            peak[0] = max(peak[0], outstanding[0])
+            await asyncio.sleep(0.01)
+            outstanding[0] -= 1
+            return body['args']
+
+        server.handlers['GET_CHANNEL'] = counted
+        ids = list(range(12)) + [0, '1', 2, 2]
+        replies = await client.get_channels_bulk(ids, limit=3)
+        assert sorted(replies, key=int) == [str(i) for i in range(12)]
+        assert all(replies[i]['data'] == {'channel_id': i} for i in replies)
+        assert len(server.received) == 12
+        assert peak[0] == 3
+
+    run(tmp_path, test)
+
+
+def test_bulk_first_error_cancels_the_rest(tmp_path):
+    async def test(server, client):
+        async def fail_on_two(body):
+            if body['args']['channel_id'] == '2':
+                raise fakediscord.ServerError('no such channel')
+            await asyncio.sleep(0.05)
+            return body['args']
+
+        server.handlers['GET_CHANNEL'] = fail_on_two
+        with pytest.raises(ServerError):
+            await client.get_channels_bulk(range(10), limit=3)
+        await asyncio.sleep(0.1)
+        # Only the first three were ever sent, and nothing is left waiting on a reply.
+        assert [body['args']['channel_id'] for body in server.received] == ['0', '1', '2']
+        assert not client._pending
+
+    run(tmp_path, test)
@@ -0,0 +1,88 @@
+import asyncio
+import sys
+
+import pytest
+
+import fakediscord
+from client import AioClient, ResponseCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def cache(**kwargs):
+    clock = Clock()
+    return ResponseCache(clock=clock, **kwargs), clock
+
+
+def test_hit_until_the_ttl_runs_out():
+    responses, clock = cache(ttl=10.0)
+    responses.put(('GET_GUILD', '1'), {'data': 1}, responses.generation('GET_GUILD'))
+    assert responses.get(('GET_GUILD', '1')) == {'data': 1}
+    clock.now = 10.0
+    assert responses.get(('GET_GUILD', '1')) is None
+    assert responses.stats == {'hits': 1, 'misses': 1, 'evictions': 0, 'expired': 1}
+
+
+def test_least_recently_used_entry_is_evicted():
+    responses, _ = cache(maxsize=2)
+    for i in '123':
+        responses.put(('GET_CHANNEL', i), i, 0)
+    assert responses.get(('GET_CHANNEL', '1')) is None
+    assert responses.get(('GET_CHANNEL', '3')) == '3'
+    assert responses.evictions == 1
+
+
+def test_event_invalidates_only_its_commands():
+    responses, _ = cache()
+    responses.put(('GET_GUILD', '1'), 'guild', 0)
+    responses.put(('GET_GUILDS',), 'guilds', 0)
+    responses.put(('GET_CHANNELS', '1'), 'channels', 0)
+    responses.on_event('GUILD_CREATE')
+    assert responses.get(('GET_GUILD', '1')) is None
+    assert responses.get(('GET_GUILDS',)) is None
+    assert responses.get(('GET_CHANNELS', '1')) == 'channels'
+    responses.on_event('SPEAKING_START')
+    assert responses.get(('GET_CHANNELS', '1')) == 'channels'
+
+
+def test_reply_fetched_across_an_invalidation_is_not_stored():
+    responses, _ = cache()
+    generation = responses.generation('GET_GUILDS')
+    # GUILD_CREATE lands while GET_GUILDS is in flight: its reply may already be stale.
+    responses.on_event('GUILD_CREATE')
+    responses.put(('GET_GUILDS',), 'stale', generation)
+    assert responses.get(('GET_GUILDS',)) is None
+    responses.put(('GET_GUILDS',), 'fresh', responses.generation('GET_GUILDS'))
+    assert responses.get(('GET_GUILDS',)) == 'fresh'
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='the fake endpoint is a unix socket')
+def test_client_refetches_after_an_event_or_a_write(tmp_path):
+    async def main():
+        server = await fakediscord.FakeDiscord(str(tmp_path / 'discord-ipc-0')).start()
+        client = AioClient('1', ipc_path=server.path, cache_ttl=60)
+        await client.start()
+        try:
+            first = await client.get_guild(1)
+            assert await client.get_guild(1) is first
+            server.dispatch('GUILD_CREATE')
+            await asyncio.sleep(0.05)
+            assert await client.get_guild(1) is not first
+
+            await client.get_voice_settings()
+            await client.get_voice_settings()
+            await client.set_voice_settings(mute=True)
+            await client.get_voice_settings()
+            commands = [body['cmd'] for body in server.received]
+            assert commands.count('GET_GUILD') == 2
+            assert commands.count('GET_VOICE_SETTINGS') == 2
+        finally:
+            client._close_pipe()
+            await server.close()
+    asyncio.run(main())
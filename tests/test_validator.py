@@ -0,0 +1,65 @@
+import pytest
+
+from exceptions import InvalidArgument
+from payloads import Activity, ActivityValidator
+
+
+def test_valid_activity_passes_through_unchanged():
+    validate = ActivityValidator()
+    activity = Activity(details='Song by Artist', state='from Album', party_size=[1, 4])
+    assert validate(activity) is activity
+    assert validate.fixed == 0
+
+
+def test_truncate_clips_long_text_with_an_ellipsis():
+    validate = ActivityValidator('truncate')
+    fixed = validate(Activity(details='x' * 200, large_text='y' * 129))
+    assert len(fixed.details) == 128 and fixed.details.endswith('…')
+    assert len(fixed.large_text) == 128
+    assert validate.fixed == 1
+
+
+def test_truncate_drops_extra_buttons_and_clips_labels():
+    buttons = [{'label': 'l' * 40, 'url': 'https://a'}, {'label': 'b', 'url': 'https://b'},
+               {'label': 'c', 'url': 'https://c'}]
+    fixed = ActivityValidator('truncate')(Activity(buttons=buttons))
+    assert [button['url'] for button in fixed.buttons] == ['https://a', 'https://b']
+    assert len(fixed.buttons[0]['label']) == 32
+
+
+def test_truncate_leaves_out_a_bad_party_size():
+    fixed = ActivityValidator('truncate')(Activity(details='d', party_size=[5, 2]))
+    assert fixed.party_size is None
+    assert fixed.details == 'd'
+
+
+def test_strict_raises_instead():
+    validate = ActivityValidator('strict')
+    with pytest.raises(InvalidArgument, match='at most 128 characters'):
+        validate(Activity(state='s' * 129))
+    assert validate.rejected == 1
+
+
+def test_results_are_cached_per_activity():
+    validate = ActivityValidator('truncate')
+    first = validate(Activity(details='x' * 200))
+    assert validate(Activity(details='x' * 200)) is first
+    assert validate.fixed == 1
+
+
+def test_cached_rejection_raises_a_fresh_exception_each_time():
+    validate = ActivityValidator('strict')
+    activity = Activity(details='x' * 200)
+    raised = []
+    for _ in range(2):
+        with pytest.raises(InvalidArgument) as info:
+            validate(activity)
+        raised.append(info.value)
+    assert raised[0] is not raised[1]
+    assert str(raised[0]) == str(raised[1])
+    assert validate.rejected == 1
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(InvalidArgument):
+        ActivityValidator('lenient')
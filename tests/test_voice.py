@@ -0,0 +1,110 @@
+import asyncio
+
+from voice import _diff, _merge, user_voice_settings_writer, voice_settings_writer
+
+
+class FakeClient:
+    """Answers GET_VOICE_SETTINGS with ``settings`` and echoes SET_* args."""
+    cache = None
+
+    def __init__(self, settings: dict = None):
+        self.settings = settings or {'mute': False, 'deaf': False, 'input': {'volume': 50, 'device_id': 'a'}}
+        self.writes = []
+        self.timeouts = []
+        self.fail = None
+
+    async def request(self, payload, timeout: float = None):
+        data = payload.data
+        if data['cmd'] == 'GET_VOICE_SETTINGS':
+            return {'data': self.settings}
+        if self.fail is not None:
+            raise self.fail
+        self.writes.append(data['args'])
+        self.timeouts.append(timeout)
+        return {'data': data['args']}
+
+
+def test_diff_keeps_only_changed_leaves():
+    known = {'mute': False, 'input': {'volume': 50, 'device_id': 'a'}}
+    assert _diff({'mute': False, 'input': {'volume': 60, 'device_id': 'a'}}, known) == {'input': {'volume': 60}}
+    assert _diff({'mute': False}, known) == {}
+    assert _diff({'deaf': True}, known) == {'deaf': True}
+
+
+def test_merge_is_deep_and_copies():
+    into = {'input': {'volume': 1}}
+    new = {'input': {'device_id': 'b'}, 'mode': {'type': 'PTT'}}
+    _merge(into, new)
+    new['mode']['type'] = 'VOICE_ACTIVITY'
+    assert into == {'input': {'volume': 1, 'device_id': 'b'}, 'mode': {'type': 'PTT'}}
+
+
+def test_calls_within_an_interval_become_one_delta_write():
+    async def main():
+        client = FakeClient()
+        writer = voice_settings_writer(client, 0.01)
+        calls = [writer.set({'input': {'volume': v}}) for v in range(40, 70)]
+        calls.append(writer.set({'mute': False}))
+        replies = await asyncio.gather(*calls)
+        assert client.writes == [{'input': {'volume': 69}}]
+        assert all(reply == {'data': {'input': {'volume': 69}}} for reply in replies)
+        assert (writer.writes, writer.merged) == (1, 30)
+        assert writer.known['input'] == {'volume': 69, 'device_id': 'a'}
+    asyncio.run(main())
+
+
+def test_nothing_new_skips_the_write():
+    async def main():
+        client = FakeClient()
+        writer = voice_settings_writer(client, 0.0)
+        assert await writer.set({'mute': False, 'input': {'volume': 50}}) is None
+        assert client.writes == [] and writer.skipped == 1
+    asyncio.run(main())
+
+
+def test_event_keeps_known_state_current():
+    async def main():
+        client = FakeClient()
+        writer = voice_settings_writer(client, 0.0)
+        await writer.set({'mute': True})
+        writer.seed({'mute': False})  # VOICE_SETTINGS_UPDATE: muted again elsewhere, then unmuted
+        await writer.set({'mute': True})
+        assert client.writes == [{'mute': True}, {'mute': True}]
+    asyncio.run(main())
+
+
+def test_merged_write_uses_the_shortest_timeout():
+    async def main():
+        client = FakeClient()
+        writer = voice_settings_writer(client, 0.01)
+        await asyncio.gather(writer.set({'mute': True}, timeout=5.0), writer.set({'deaf': True}, timeout=0.5),
+                             writer.set({'deaf': True}))
+        assert client.timeouts == [0.5]
+        await writer.set({'deaf': False})
+        assert client.timeouts == [0.5, None]
+    asyncio.run(main())
+
+
+def test_failed_write_fails_every_merged_call():
+    async def main():
+        client = FakeClient()
+        writer = voice_settings_writer(client, 0.01)
+        client.fail = ConnectionResetError()
+        results = await asyncio.gather(writer.set({'mute': True}), writer.set({'deaf': True}),
+                                       return_exceptions=True)
+        assert all(isinstance(result, ConnectionResetError) for result in results)
+        client.fail = None
+        await writer.set({'mute': True})
+        assert client.writes == [{'mute': True}]
+    asyncio.run(main())
+
+
+def test_user_settings_start_with_everything_then_send_deltas():
+    async def main():
+        client = FakeClient()
+        writer = user_voice_settings_writer(client, 0.0, '7')
+        await writer.set({'pan': {'left': 0.5, 'right': 1.0}, 'volume': 80})
+        await writer.set({'pan': {'left': 0.5, 'right': 0.8}, 'volume': 80})
+        assert client.writes == [{'user_id': '7', 'pan': {'left': 0.5, 'right': 1.0}, 'volume': 80},
+                                 {'user_id': '7', 'pan': {'right': 0.8}}]
+    asyncio.run(main())
@@ -1,7 +1,7 @@
 """Util functions that are needed but messy."""
 import asyncio
-import json
-import time
+import threading
+from collections import OrderedDict
 
 from exceptions import PyPresenceException
 
@@ -19,29 +19,96 @@ def remove_none(d: dict):
     return d
 
 
-# Don't call these. Ever.
-def _load_payloads(filename):
-    with open(filename, 'r') as fp:
-        f = fp.read()
+class LRUCache:
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    payloaddict = {}
-    for line in f.splitlines():
-        name, payload = line.split('||')
-        payloaddict[name] = payload
+    def __len__(self):
+        return len(self._data)
 
-    return payloaddict
+    def __contains__(self, key):
+        return key in self._data
 
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
 
-def _payload_gen(payload_type: str, payload_params: dict):
-    payloads = _load_payloads('pllist.NEKO')  # dont like txt files
-    if payload_type.upper() not in payloads:
-        raise PyPresenceException('Payload type not supported or does not exist.')
-    payload_str = payloads[payload_type]
-    for key, value in payload_params.items():
-        payload_str.replace(";;{0};;".format(key), value)
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
 
-    payload = json.loads(payload_str)
-    payload["nonce"] = payload["nonce"].format(time.time())
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def keys(self):
+        return list(self._data)
+
+    def clear(self):
+        self._data.clear()
+
+
+# Payload templates. These used to be read from pllist.NEKO on every call; now each
+# payload shape is compiled once per codec into static byte fragments and only the
+# dynamic values are encoded when rendering.
+_SLOT = '\x00;;slot;;\x00'
+_templates = {}
+
+
+def _build_skeleton(static: dict, paths: tuple) -> dict:
+    skeleton = dict(static)
+    for path in paths:
+        node = skeleton
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = _SLOT
+    return skeleton
+
+
+def _payload_tree(static: dict, fields: list) -> dict:
+    """The dict a template renders, for callers that need the decoded form."""
+    tree = dict(static)
+    for path, value in fields:
+        node = tree
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = value
+    return tree
+
+
+def _payload_gen(payload_type: str, static: dict, shape, fields: list, codec) -> bytes:
+    """Render ``static`` plus ``fields`` (``(path, value)`` pairs, None already left
+    out, in document order) exactly as ``codec.dumps`` would encode the whole tree.
+
+    ``shape`` is any hashable that identifies which paths are present.
+    """
+    key = (payload_type, shape, codec.name)
+    fragments = _templates.get(key)
+    if fragments is None:
+        paths = tuple(path for path, _ in fields)
+        fragments = codec.dumps(_build_skeleton(static, paths)).split(codec.dumps(_SLOT))
+        if len(fragments) != len(paths) + 1:
+            raise PyPresenceException('Payload template for {0} could not be compiled.'.format(payload_type))
+        _templates[key] = fragments
+
+    dumps = codec.dumps_value
+    out = [fragments[0]]
+    for (_, value), fragment in zip(fields, fragments[1:]):
+        out.append(dumps(value))
+        out.append(fragment)
+    return b''.join(out)
 
 
 # This code used to do something. I don't know what, though.
@@ -50,3 +117,32 @@ try:  # Thanks, Rapptz :^)
 except AttributeError:
     create_task = getattr(asyncio, "async")
     # No longer crashes Python 3.7
+
+
+class LoopThread:
+    """Runs an event loop forever on a daemon thread. The loop is never made the thread's
+    current loop anywhere else, so it can't clash with a loop the application owns."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, name: str = 'pypresence'):
+        self.loop = loop
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def in_loop(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def submit(self, coro):
+        """Schedule ``coro`` on the loop from any thread. Returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        if self._thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            if not self.in_loop():
+                self._thread.join()
+        if not self.loop.is_running():
+            self.loop.close()
@@ -0,0 +1,147 @@
+"""Delta-only, batched voice settings writes.
+
+Turned on with ``voice_interval=`` on Client/AioClient. The client then remembers the
+last known settings and, instead of writing every argument of every call, collects
+calls for ``voice_interval`` seconds and sends one SET_* frame with just the fields
+that differ from what Discord already has. A slider dragged across a hundred values
+in a second becomes a handful of small writes.
+"""
+import asyncio
+import copy
+
+from payloads import Payload
+
+
+def _diff(new: dict, known: dict) -> dict:
+    delta = {}
+    for key, value in new.items():
+        old = known.get(key)
+        if isinstance(value, dict) and isinstance(old, dict):
+            changed = _diff(value, old)
+            if changed:
+                delta[key] = changed
+        elif value != old:
+            delta[key] = value
+    return delta
+
+
+def _merge(into: dict, new: dict):
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(into.get(key), dict):
+            _merge(into[key], value)
+        else:
+            into[key] = copy.deepcopy(value)
+
+
+class DeltaWriter:
+    """Merges calls for one settings target and writes only what changed.
+
+    ``build(args)`` makes the SET_* payload from a delta. ``fetch``, if given, is a
+    coroutine function returning the current settings, used once before the first write.
+    ``stale`` is a cached command to invalidate after each write.
+    """
+
+    def __init__(self, client, interval: float, build, fetch=None, stale: str = None):
+        self.client = client
+        self.interval = interval
+        self.build = build
+        self.fetch = fetch
+        self.stale = stale
+        self.known = None if fetch is not None else {}
+        self.writes = 0
+        self.merged = 0
+        self.skipped = 0
+        self._pending = {}
+        self._timeout = None
+        self._waiters = []
+        self._flush = None  # type: asyncio.Task
+        self._seeding = None  # type: asyncio.Task
+
+    def seed(self, settings: dict):
+        """Record settings Discord reported, from a reply or a VOICE_SETTINGS_UPDATE event."""
+        if self.known is None:
+            self.known = {}
+        _merge(self.known, settings)
+
+    async def _seed(self, timeout: float):
+        if self._seeding is None:
+            self._seeding = asyncio.ensure_future(self.fetch(timeout))
+        try:
+            settings = await asyncio.shield(self._seeding)
+        except Exception:
+            self._seeding = None
+            raise
+        if self.known is None:
+            self.seed(settings)
+
+    async def merge(self, args: dict, timeout: float = None) -> asyncio.Future:
+        """Queue ``args`` for the next write without waiting for it. Returns a future for its reply.
+
+        The write waits at most the shortest ``timeout`` given by any call it merges.
+        """
+        if self.known is None:
+            await self._seed(timeout)
+        if self._waiters:
+            self.merged += 1
+        _merge(self._pending, args)
+        if timeout is not None:
+            self._timeout = timeout if self._timeout is None else min(self._timeout, timeout)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        if self._flush is None:
+            self._flush = asyncio.ensure_future(self._write_later())
+        return waiter
+
+    async def set(self, args: dict, timeout: float = None):
+        """Queue ``args`` and wait for the write. Returns its reply, or None if nothing needed sending."""
+        return await (await self.merge(args, timeout))
+
+    async def _write_later(self):
+        await asyncio.sleep(self.interval)
+        pending, self._pending = self._pending, {}
+        waiters, self._waiters = self._waiters, []
+        timeout, self._timeout = self._timeout, None
+        self._flush = None
+        delta = _diff(pending, self.known)
+        try:
+            if not delta:
+                self.skipped += 1
+                reply = None
+            else:
+                self.writes += 1
+                reply = await self.client.request(self.build(delta), timeout=timeout)
+                self.seed(delta)
+                if self.stale is not None and getattr(self.client, 'cache', None) is not None:
+                    self.client.cache.invalidate(self.stale)
+        except BaseException as e:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            return
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(reply)
+
+
+def voice_settings_writer(client, interval: float) -> DeltaWriter:
+    async def fetch(timeout):
+        reply = await client.request(Payload.get_voice_settings(), timeout=timeout)
+        return reply['data']
+
+    def build(delta):
+        return Payload.set_voice_settings(delta.get('input'), delta.get('output'), delta.get('mode'),
+                                          delta.get('automatic_gain_control'), delta.get('echo_cancellation'),
+                                          delta.get('noise_suppression'), delta.get('qos'),
+                                          delta.get('silence_warning'), delta.get('deaf'), delta.get('mute'))
+
+    return DeltaWriter(client, interval, build, fetch, stale='GET_VOICE_SETTINGS')
+
+
+def user_voice_settings_writer(client, interval: float, user_id: str) -> DeltaWriter:
+    # There is no GET for another user's settings, so the first write sends everything it was given.
+    def build(delta):
+        pan = delta.get('pan') or {}
+        return Payload.set_user_voice_settings(user_id, pan.get('left'), pan.get('right'),
+                                               delta.get('volume'), delta.get('mute'))
+
+    return DeltaWriter(client, interval, build)